@@ -0,0 +1,398 @@
+"""Offline load test for the bot.
+
+Runs the real handlers from main.py against local stand-ins for the Telegram
+Bot API, Groq (OpenAI-compatible), Open-Meteo and Unsplash, replays a
+synthetic update mix at a target rate and reports latency per mode.
+
+    python benchmark.py --scenario chat-heavy --rate 20 --duration 60
+
+Latency is measured from the moment an update is handed to getUpdates:
+"first" is the first message/edit/callback answer the bot sends to that chat,
+"done" is the last one before the chat goes quiet for --settle seconds.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import threading
+import subprocess
+from collections import defaultdict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+TOKEN = "123456:bench"
+
+# --- SYNTHETIC WORKLOAD ---
+
+CITIES = ["London", "Paris", "Tokyo", "New York", "Berlin", "Mumbai", "Sydney", "Cairo", "Lima", "Toronto"]
+TOPICS = ["cats", "mountains", "sunset", "coffee", "flowers", "ocean", "city lights", "forest"]
+MATH = ["2+2", "sqrt(2)*3", "x^2-5x+6=0", "(1+2i)*(3-i)", "sin(30°)",
+        "A train leaves at 3pm going 60 km/h, when does it reach a city 150 km away?"]
+CHAT = ["hi!", "tell me a fun fact", "what should I cook tonight?", "explain black holes simply", "thanks!"]
+DREAMS = ["I was flying over a city made of glass", "a door kept appearing in every room", "the sea was full of stars"]
+MENU = ["/start", "🎮 Play Game", "🎨 AI Gen", "📚 HERMAX_ARTICLES", "📰 HERMAX_NEWS", "🔙 Back"]
+
+# persona -> (menu selection, list of follow-up steps); a step is text or ("video",) / ("callback", data)
+PERSONAS = {
+    "weather": ("🌦️ Weather", CITIES),
+    "time": ("⏰ Time", CITIES),
+    "images": ("🖼️ Images", TOPICS + ["➕ More images"]),
+    "math": ("🧮 Math", MATH),
+    "ai_chat": ("🤖 AI Chat", CHAT),
+    "dreamriddle": ("🌀 Dreamriddle", DREAMS),
+    "gif": ("📹 Video to GIF", [("video",), ("callback", "vid_animation"), ("video",), ("callback", "vid_gif")]),
+    "menu": (None, MENU),
+}
+
+SCENARIOS = {
+    "chat-heavy": {"ai_chat": 5, "dreamriddle": 2, "math": 2, "weather": 1},
+    "media-heavy": {"gif": 5, "images": 3, "ai_chat": 1, "menu": 1},
+    "menu-spam": {"menu": 8, "time": 1, "weather": 1},
+    "mixed": {"weather": 2, "time": 2, "images": 2, "math": 2, "ai_chat": 2, "dreamriddle": 1, "gif": 1, "menu": 2},
+}
+
+# --- RECORDING ---
+
+class Recorder:
+    """Matches bot output to the update that caused it (one outstanding update per chat)."""
+
+    def __init__(self, settle):
+        self.settle = settle
+        self.lock = threading.Lock()
+        self.outstanding = {}  # chat_id -> [mode, sent_at, first_at, last_at]
+        self.first = defaultdict(list)
+        self.done = defaultdict(list)
+        self.sends = 0
+
+    def issued(self, chat_id, mode):
+        with self.lock:
+            self.outstanding[chat_id] = [mode, time.monotonic(), None, None]
+
+    def bot_output(self, chat_id):
+        now = time.monotonic()
+        with self.lock:
+            self.sends += 1
+            entry = self.outstanding.get(chat_id)
+            if entry:
+                entry[2] = entry[2] or now
+                entry[3] = now
+
+    def settled(self):
+        """Finish chats that have been quiet for `settle` seconds; returns their ids."""
+        now = time.monotonic()
+        finished = []
+        with self.lock:
+            for chat_id, (mode, sent_at, first_at, last_at) in list(self.outstanding.items()):
+                if last_at and now - last_at >= self.settle:
+                    self.first[mode].append(first_at - sent_at)
+                    self.done[mode].append(last_at - sent_at)
+                    del self.outstanding[chat_id]
+                    finished.append(chat_id)
+        return finished
+
+# --- FAKE UPSTREAMS ---
+
+class FakeUpstreams:
+    def __init__(self, recorder, llm_latency, llm_tokens, token_interval, upstream_latency, media_path):
+        self.recorder = recorder
+        self.llm_latency = llm_latency
+        self.llm_tokens = llm_tokens
+        self.token_interval = token_interval
+        self.upstream_latency = upstream_latency
+        self.media_path = media_path
+        self.updates = deque()
+        self.updates_ready = threading.Condition()
+        self.message_ids = iter(range(1, 10 ** 9))
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def push_update(self, update):
+        with self.updates_ready:
+            self.updates.append(update)
+            self.updates_ready.notify()
+
+    def take_updates(self, offset, timeout):
+        with self.updates_ready:
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.popleft()
+            if not self.updates:
+                self.updates_ready.wait(timeout)
+            return list(self.updates)[:100]
+
+    def message(self, chat_id, **extra):
+        msg = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        msg.update(extra)
+        return msg
+
+    def bot_api(self, method, params):
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        if method == "getUpdates":
+            return self.take_updates(int(params.get("offset", 0)), min(float(params.get("timeout", 1)), 1.0))
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method in ("deleteWebhook", "setWebhook", "sendChatAction"):
+            return True
+        if method == "answerCallbackQuery":
+            self.recorder.bot_output(int(params["callback_query_id"].split(":")[0]))
+            return True
+        if method == "getFile":
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"], "file_size": os.path.getsize(self.media_path),
+                    "file_path": "videos/clip.mp4"}
+        if chat_id is not None:
+            self.recorder.bot_output(chat_id)
+        if method == "sendMediaGroup":
+            return [self.message(chat_id, photo=[{"file_id": f"photo{random.random()}", "file_unique_id": "p", "width": 1, "height": 1}])
+                    for _ in json.loads(params["media"])]
+        if method in ("sendAudio", "sendDocument", "sendAnimation"):
+            kind = {"sendAudio": "audio", "sendDocument": "document", "sendAnimation": "animation"}[method]
+            media = {"file_id": f"out{random.random()}", "file_unique_id": "o", "duration": 1, "width": 1, "height": 1}
+            return self.message(chat_id, **{kind: media})
+        if method in ("sendMessage", "editMessageText", "sendPhoto"):
+            return self.message(chat_id, text=params.get("text", ""))
+        return True
+
+    def completion(self, handler, body):
+        time.sleep(self.llm_latency)
+        words = [random.choice(["✨", "sure", "the", "answer", "is", "42", "dream", "🌸"]) for _ in range(self.llm_tokens)]
+        model = body.get("model", "fake")
+        if not body.get("stream"):
+            handler.reply_json({
+                "id": "cmpl", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": len(words), "total_tokens": 100 + len(words)},
+            })
+            return
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        handler.close_connection = True
+        for word in words:
+            chunk = {"id": "cmpl", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            handler.wfile.flush()
+            time.sleep(self.token_interval)
+        handler.wfile.write(b"data: [DONE]\n\n")
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply_json(self, payload, status=200):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _params(self, url):
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                    params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+                return params, body
+
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                params, body = self._params(url)
+                parts = url.path.strip("/").split("/")
+                if parts[:2] == ["tg", "file"]:
+                    with open(fake.media_path, "rb") as f:
+                        data = f.read()
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                elif parts[0] == "tg":
+                    self.reply_json({"ok": True, "result": fake.bot_api(parts[-1], params)})
+                elif parts[0] == "groq":
+                    fake.completion(self, json.loads(body or b"{}"))
+                elif parts[0] == "geo":
+                    time.sleep(fake.upstream_latency)
+                    name = params.get("name", "somewhere").title()
+                    self.reply_json({"results": [{"name": name, "country": "Benchland", "latitude": 51.5, "longitude": -0.12,
+                                                  "timezone": "Europe/London"}]})
+                elif parts[0] == "forecast":
+                    time.sleep(fake.upstream_latency)
+                    self.reply_json({"current_weather": {"temperature": 18.5, "windspeed": 9.7, "weathercode": 2}})
+                elif parts[0] == "unsplash":
+                    time.sleep(fake.upstream_latency)
+                    per_page = int(params.get("per_page", 3))
+                    self.reply_json({"results": [{"id": f"{params.get('query')}-{i}", "urls": {"regular": f"https://example.invalid/{i}.jpg"}}
+                                                 for i in range(per_page)]})
+                else:
+                    self.reply_json({"ok": False, "description": "not found"}, status=404)
+
+        return Handler
+
+def make_media_file():
+    """A short test clip if ffmpeg is installed, otherwise junk bytes (media jobs will then fail fast)."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".bench_clip.mp4")
+    if not os.path.exists(path) and shutil.which("ffmpeg"):
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", "testsrc=duration=5:size=640x360:rate=25",
+                        "-pix_fmt", "yuv420p", path], check=False)
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(os.urandom(256 * 1024))
+    return path
+
+# --- DRIVER ---
+
+class SyntheticUser:
+    def __init__(self, user_id, persona):
+        self.user_id = user_id
+        self.persona = persona
+        selection, steps = PERSONAS[persona]
+        self.script = ([selection] if selection else []) + list(steps)
+        self.position = 0
+
+    def next_step(self):
+        step = self.script[self.position]
+        self.position += 1
+        if self.position == len(self.script):
+            # Loop over the follow-ups, keeping the mode we're in
+            self.position = 1 if PERSONAS[self.persona][0] else 0
+        mode = "menu" if step == PERSONAS[self.persona][0] else self.persona
+        return mode, step
+
+def make_update(update_id, user_id, step):
+    sender = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    if isinstance(step, tuple) and step[0] == "callback":
+        return {"update_id": update_id, "callback_query": {
+            "id": f"{user_id}:{update_id}", "from": sender, "chat_instance": str(user_id), "data": step[1],
+            "message": {"message_id": 1, "date": int(time.time()), "chat": chat, "text": "menu"}}}
+    message = {"message_id": update_id, "from": sender, "chat": chat, "date": int(time.time())}
+    if isinstance(step, tuple) and step[0] == "video":
+        message["video"] = {"file_id": f"video{user_id}", "file_unique_id": f"video{user_id}", "width": 640, "height": 360,
+                            "duration": 5, "mime_type": "video/mp4"}
+    else:
+        message["text"] = step
+    return {"update_id": update_id, "message": message}
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def run(args):
+    recorder = Recorder(args.settle)
+    fake = FakeUpstreams(recorder, args.llm_latency, args.llm_tokens, args.token_interval, args.upstream_latency, make_media_file())
+    fake.start()
+
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "TELEGRAM_API_URL": fake.base_url + "/tg",
+        "GROQ_BASE_URL": fake.base_url + "/groq",
+        "OPEN_METEO_GEOCODING_URL": fake.base_url + "/geo/search",
+        "OPEN_METEO_FORECAST_URL": fake.base_url + "/forecast",
+        "UNSPLASH_URL": fake.base_url + "/unsplash/search/photos",
+        "UNSPLASH_ACCESS_KEY": "bench",
+        "GROQ_API_KEY": "bench",
+        "BOT_MODE": "polling",
+        "STATE_BACKEND": "memory",
+        "LLM_STREAMING": "1" if args.stream else "0",
+    })
+    import main  # configured by the environment above
+
+    threading.Thread(target=main.bot.infinity_polling, kwargs={"timeout": 1, "long_polling_timeout": 1}, daemon=True).start()
+
+    weights = SCENARIOS[args.scenario]
+    personas = random.choices(list(weights), weights=list(weights.values()), k=args.users)
+    users = {1000 + i: SyntheticUser(1000 + i, persona) for i, persona in enumerate(personas)}
+    idle = deque(users)
+    update_ids = iter(range(1, 10 ** 9))
+    issued = skipped = 0
+
+    print(f"Running {args.scenario} at {args.rate}/s for {args.duration}s with {args.users} users...", file=sys.stderr)
+    started = time.monotonic()
+    next_at = started
+    while time.monotonic() - started < args.duration:
+        idle.extend(recorder.settled())
+        now = time.monotonic()
+        if now < next_at:
+            time.sleep(min(next_at - now, 0.01))
+            continue
+        next_at += 1 / args.rate
+        if not idle:
+            skipped += 1  # every user is still waiting for the bot
+            continue
+        user = users[idle.popleft()]
+        mode, step = user.next_step()
+        recorder.issued(user.user_id, mode)
+        fake.push_update(make_update(next(update_ids), user.user_id, step))
+        issued += 1
+
+    # Let in-flight work finish
+    drain_until = time.monotonic() + args.drain
+    while recorder.outstanding and time.monotonic() < drain_until:
+        recorder.settled()
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started
+
+    results = {
+        "scenario": args.scenario, "rate": args.rate, "duration": args.duration, "issued": issued,
+        "skipped_all_users_busy": skipped, "unanswered": len(recorder.outstanding),
+        "updates_per_second": round(sum(len(v) for v in recorder.done.values()) / elapsed, 2),
+        "bot_messages_per_second": round(recorder.sends / elapsed, 2),
+        "modes": {
+            mode: {
+                "count": len(recorder.first[mode]),
+                **{f"first_p{p}": round(percentile(recorder.first[mode], p), 4) for p in (50, 95, 99)},
+                **{f"done_p{p}": round(percentile(recorder.done[mode], p), 4) for p in (50, 95, 99)},
+            } for mode in sorted(recorder.first)
+        },
+    }
+    return results
+
+def print_table(results):
+    print(f"\nscenario={results['scenario']} rate={results['rate']}/s duration={results['duration']}s "
+          f"issued={results['issued']} skipped={results['skipped_all_users_busy']} unanswered={results['unanswered']}")
+    print(f"updates/s={results['updates_per_second']}  bot messages/s={results['bot_messages_per_second']}\n")
+    header = f"{'mode':<12}{'count':>7}" + "".join(f"{name:>11}" for name in
+                                                  ("first p50", "first p95", "first p99", "done p50", "done p95", "done p99"))
+    print(header)
+    for mode, row in results["modes"].items():
+        cells = [row["first_p50"], row["first_p95"], row["first_p99"], row["done_p50"], row["done_p95"], row["done_p99"]]
+        print(f"{mode:<12}{row['count']:>7}" + "".join(f"{cell * 1000:>9.0f}ms" for cell in cells))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+    parser.add_argument("--rate", type=float, default=10, help="updates per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to generate load")
+    parser.add_argument("--users", type=int, default=300, help="synthetic users (each has one update in flight at most)")
+    parser.add_argument("--settle", type=float, default=2.0, help="quiet seconds after which a reply counts as done")
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for in-flight updates at the end")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="fake LLM time to first token")
+    parser.add_argument("--llm-tokens", type=int, default=60, help="tokens per fake LLM reply")
+    parser.add_argument("--token-interval", type=float, default=0.02, help="seconds between streamed tokens")
+    parser.add_argument("--upstream-latency", type=float, default=0.05, help="fake Open-Meteo/Unsplash latency")
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="disable streamed LLM replies")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    results = run(args)
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
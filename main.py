@@ -1,14 +1,44 @@
 import os
+import math
+from fractions import Fraction
 import telebot
-from telebot.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+from telebot.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, InputMediaPhoto
 import openai
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 import subprocess
 import tempfile
+import shutil
 import threading
-from flask import Flask
+import time
+import random
+import queue
+import hmac
+import json
+import bisect
+import hashlib
+import atexit
+import asyncio
+import signal
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, abort
 from datetime import datetime
 import pytz
+from math_engine import solve_locally, math_cache_key
+from ttl_cache import TTLCache
+from metrics import Counter, Histogram, CallbackMetric, Timer, bounded_label
+from outbound import TELEGRAM_MAX_MESSAGE, OUTBOUND_MERGED, OUTBOUND_THROTTLED, OutboundDispatcher, unmerged
+from media_queue import JobCancelled, JobTimeout, MediaDuplicate, MediaJobQueue, MediaQueueFull, MediaUserLimit
+from rate_limit import RateLimiter
+from state_store import MemoryStateStore, SQLiteStateStore, SweepingMemoryStateStore
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 # --- CONFIGURATION ---
 # Ensure these match the Environment Variables in Render
@@ -16,32 +46,778 @@ TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 UNSPLASH_ACCESS_KEY = os.environ.get("UNSPLASH_ACCESS_KEY")
 
+# Media (ffmpeg) job limits
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", 2))
+MEDIA_QUEUE_SIZE = int(os.environ.get("MEDIA_QUEUE_SIZE", 20))
+MEDIA_JOBS_PER_USER = int(os.environ.get("MEDIA_JOBS_PER_USER", 1))
+MEDIA_QUEUED_PER_USER = int(os.environ.get("MEDIA_QUEUED_PER_USER", 3))
+MEDIA_JOB_TIMEOUT = int(os.environ.get("MEDIA_JOB_TIMEOUT", 300))  # wall clock seconds per job
+MEDIA_JOB_CPU_LIMIT = int(os.environ.get("MEDIA_JOB_CPU_LIMIT", 240))  # CPU seconds per ffmpeg run
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", 64 * 1024))
+
+# Video conversion: clips are probed first and encode settings are picked to fit these budgets
+VIDEO_MAX_SECONDS = int(os.environ.get("VIDEO_MAX_SECONDS", 180))  # longer clips are rejected up front
+GIF_MAX_SECONDS = int(os.environ.get("GIF_MAX_SECONDS", 15))  # GIFs are trimmed to this length
+GIF_PIXEL_BUDGET = int(os.environ.get("GIF_PIXEL_BUDGET", 480 * 270 * 10 * 15))  # width * height * frames
+ANIMATION_MAX_SECONDS = int(os.environ.get("ANIMATION_MAX_SECONDS", 60))  # MP4 animations are trimmed to this length
+
+# Music Edit: effect choices render a short low-bitrate preview first, the full track on request
+PREVIEW_SECONDS = int(os.environ.get("PREVIEW_SECONDS", 15))
+PREVIEW_BITRATE = os.environ.get("PREVIEW_BITRATE", "64k")
+DECODED_CACHE_TTL = int(os.environ.get("DECODED_CACHE_TTL", 600))  # keep decoded uploads while the user tries effects
+DECODED_CACHE_MAX_BYTES = int(os.environ.get("DECODED_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+
+# Admission control: token buckets per user and globally; actions cost more the heavier they are
+USER_RATE = float(os.environ.get("USER_RATE", 1.0))  # tokens refilled per second
+USER_BURST = float(os.environ.get("USER_BURST", 15))
+GLOBAL_RATE = float(os.environ.get("GLOBAL_RATE", 100))
+GLOBAL_BURST = float(os.environ.get("GLOBAL_BURST", 300))
+ACTION_COSTS = {"cheap": 1, "lookup": 2, "preview": 4, "llm": 5, "media": 10}
+
+# Upstream HTTP + caching
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 10))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 20))
+GEOCODE_CACHE_SIZE = int(os.environ.get("GEOCODE_CACHE_SIZE", 5000))
+GEOCODE_CACHE_TTL = int(os.environ.get("GEOCODE_CACHE_TTL", 7 * 24 * 3600))
+WEATHER_CACHE_SIZE = int(os.environ.get("WEATHER_CACHE_SIZE", 2000))
+WEATHER_CACHE_TTL = int(os.environ.get("WEATHER_CACHE_TTL", 600))
+
+GEOCODING_URL = os.environ.get("OPEN_METEO_GEOCODING_URL", "https://geocoding-api.open-meteo.com/v1/search")
+FORECAST_URL = os.environ.get("OPEN_METEO_FORECAST_URL", "https://api.open-meteo.com/v1/forecast")
+
+# Images (Unsplash): one search fetches several pages worth, served 3 at a time from cache
+UNSPLASH_URL = os.environ.get("UNSPLASH_URL", "https://api.unsplash.com/search/photos")
+IMAGE_PAGE_SIZE = 3
+IMAGE_FETCH_SIZE = int(os.environ.get("IMAGE_FETCH_SIZE", 15))
+IMAGE_CACHE_SIZE = int(os.environ.get("IMAGE_CACHE_SIZE", 2000))
+IMAGE_CACHE_TTL = int(os.environ.get("IMAGE_CACHE_TTL", 3600))
+
+# User state persistence: "sqlite" (survives restarts) or "memory"
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite")
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "bot_state.db")
+STATE_HOT_SIZE = int(os.environ.get("STATE_HOT_SIZE", 5000))  # sessions kept in memory
+STATE_IDLE_TTL = int(os.environ.get("STATE_IDLE_TTL", 1800))  # seconds before an idle session leaves memory
+STATE_SESSION_TTL = int(os.environ.get("STATE_SESSION_TTL", 30 * 24 * 3600))  # seconds before an idle session is deleted
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", 2.0))
+
+# Conversation context for AI Chat and Dreamriddle: recent turns verbatim, older ones summarized
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 1500))
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", 300))
+CONTEXT_MAX_TURNS = 100  # hard cap on stored turns in case summarizing keeps failing
+
+# Rendered media outputs, reused by Telegram file_id (and optionally from local disk)
+PIPELINE_VERSION = 2  # bump when ffmpeg settings change so old renders aren't reused
+OUTPUT_CACHE_SIZE = int(os.environ.get("OUTPUT_CACHE_SIZE", 20000))
+OUTPUT_CACHE_TTL = int(os.environ.get("OUTPUT_CACHE_TTL", 30 * 24 * 3600))
+OUTPUT_CACHE_DIR = os.environ.get("OUTPUT_CACHE_DIR")  # unset = don't keep files on disk
+OUTPUT_CACHE_MAX_BYTES = int(os.environ.get("OUTPUT_CACHE_MAX_BYTES", 500 * 1024 * 1024))
+
+# LLM gateway (Groq, OpenAI-compatible)
+GROQ_BASE_URL = os.environ.get("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
+LLM_MODEL = os.environ.get("LLM_MODEL", "groq/compound-mini")
+LLM_FALLBACK_MODEL = os.environ.get("LLM_FALLBACK_MODEL", "llama-3.1-8b-instant")  # empty to disable
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 8))
+LLM_SLOT_TIMEOUT = float(os.environ.get("LLM_SLOT_TIMEOUT", 15))  # seconds to wait for a free slot
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 3))
+LLM_MAX_RETRY_WAIT = float(os.environ.get("LLM_MAX_RETRY_WAIT", 10))
+LLM_USER_TOKENS_PER_HOUR = int(os.environ.get("LLM_USER_TOKENS_PER_HOUR", 60000))
+LLM_MODEL_TOKENS_PER_MINUTE = int(os.environ.get("LLM_MODEL_TOKENS_PER_MINUTE", 60000))
+
+# LLM replies
+LLM_STREAMING = os.environ.get("LLM_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5))  # seconds between edits of one message
+
+# Math answers (local and LLM) cached by normalized problem text
+MATH_CACHE_SIZE = int(os.environ.get("MATH_CACHE_SIZE", 5000))
+MATH_CACHE_TTL = int(os.environ.get("MATH_CACHE_TTL", 24 * 3600))
+
+# Update ingestion: "polling" for local dev, "webhook" in production,
+# "sharded" to spread webhook updates over several worker processes by user
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # public base URL, e.g. https://my-bot.onrender.com
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", 500))
+POLLING_THREADS = int(os.environ.get("POLLING_THREADS", 2))  # telebot's handler pool in polling mode
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", os.cpu_count() or 2))  # worker processes in sharded mode
+SHARD_DRAIN_TIMEOUT = int(os.environ.get("SHARD_DRAIN_TIMEOUT", 120))  # seconds a stopping worker gets to finish media jobs
+
+# Execution engine for the I/O-bound text modes (weather/time, images, math, chat, dreams):
+# "threads" runs them on the handler threads, "asyncio" hands them to one event loop
+# so thousands of conversations can wait on upstream APIs without holding a thread each
+ENGINE = os.environ.get("ENGINE", "threads")
+ASYNC_MAX_TASKS = int(os.environ.get("ASYNC_MAX_TASKS", 5000))  # conversations in flight on the loop
+
+# Outbound Bot API sends. Telegram allows about one message per second per chat
+# (short bursts are fine), 20 per minute in groups and ~30 per second overall.
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", 1.0))
+OUTBOUND_CHAT_BURST = float(os.environ.get("OUTBOUND_CHAT_BURST", 3))
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", 20 / 60))
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", 30))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", 3))  # resends after a 429
+OUTBOUND_MAX_RETRY_WAIT = float(os.environ.get("OUTBOUND_MAX_RETRY_WAIT", 60))  # give up on longer retry_after
+# Longest a handler or media thread is held by one send (its turn plus any 429 pauses);
+# past that the send fails so a few throttled chats can't stall every thread
+OUTBOUND_MAX_WAIT = float(os.environ.get("OUTBOUND_MAX_WAIT", 10))
+
+# Alternative Bot API server (a local telegram-bot-api instance, or the benchmark's stand-in)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
 if not TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN not set. Please check your environment variables.")
 
-bot = telebot.TeleBot(TOKEN)
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL.rstrip('/') + "/file/bot{0}/{1}"
+
+if BOT_MODE not in ("polling", "webhook", "sharded"):
+    raise ValueError(f"Unknown BOT_MODE {BOT_MODE!r}. Use 'polling', 'webhook' or 'sharded'.")
+
+if BOT_MODE in ("webhook", "sharded") and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    raise ValueError(f"WEBHOOK_URL and WEBHOOK_SECRET must be set when BOT_MODE={BOT_MODE}.")
+
+if ENGINE not in ("threads", "asyncio"):
+    raise ValueError(f"Unknown ENGINE {ENGINE!r}. Use 'threads' or 'asyncio'.")
+
+if SHARD_WORKERS < 1:
+    raise ValueError("SHARD_WORKERS must be at least 1.")
+
+# Sharded mode runs a router process, which only takes webhooks and supervises, and
+# SHARD_WORKERS spawned workers that handle updates. Workers have a parent process.
+SHARD_ROUTER = BOT_MODE == "sharded" and multiprocessing.parent_process() is None
+HANDLES_UPDATES = not SHARD_ROUTER
+
+if BOT_MODE == "sharded" and HANDLES_UPDATES:
+    # Limits above are for the whole bot, so each worker gets an even share, keeping
+    # at least one slot and a global burst that fits the costliest action
+    GLOBAL_RATE /= SHARD_WORKERS
+    GLOBAL_BURST = max(GLOBAL_BURST / SHARD_WORKERS, max(ACTION_COSTS.values()))
+    OUTBOUND_GLOBAL_RATE /= SHARD_WORKERS
+    LLM_MAX_CONCURRENCY = max(1, LLM_MAX_CONCURRENCY // SHARD_WORKERS)
+    LLM_MODEL_TOKENS_PER_MINUTE = -(-LLM_MODEL_TOKENS_PER_MINUTE // SHARD_WORKERS)  # 0 stays "no limit"
+    MEDIA_WORKERS = max(1, MEDIA_WORKERS // SHARD_WORKERS)
+
+# In webhook modes our own worker pool runs the handlers, so telebot doesn't need its thread pool
+bot = telebot.TeleBot(TOKEN, threaded=BOT_MODE == "polling", num_threads=POLLING_THREADS)
 app = Flask(__name__)
 
 # --- STATE MANAGEMENT ---
-# Stores user modes and history in memory (clears on restart)
-user_states = {}
+# Stores user modes and history. Handlers get copies; all changes go through
+# update_state / reset_state / append_state so they are safe across threads.
+
+def make_state_store():
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStateStore(STATE_DB_PATH, STATE_HOT_SIZE, STATE_IDLE_TTL, STATE_SESSION_TTL, STATE_FLUSH_INTERVAL)
+    if STATE_BACKEND == "memory":
+        return SweepingMemoryStateStore(STATE_HOT_SIZE, STATE_IDLE_TTL)
+    raise ValueError(f"Unknown STATE_BACKEND {STATE_BACKEND!r}. Use 'sqlite' or 'memory'.")
+
+# The shard router never handles updates, so it doesn't open the database
+user_states = make_state_store() if HANDLES_UPDATES else MemoryStateStore(STATE_HOT_SIZE, STATE_IDLE_TTL)
+
+# --- METRICS ---
+# Prometheus text-format metrics served on /metrics (see metrics.py).
+
+def process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        # Peak rather than current, but better than nothing off Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else 0
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Time spent handling an update, by handler and mode.", ("handler", "mode"))
+UPSTREAM_SECONDS = Histogram("bot_upstream_seconds", "Latency of calls to upstream APIs.", ("service",))
+UPSTREAM_ERRORS = Counter("bot_upstream_errors_total", "Failed calls to upstream APIs.", ("service",))
+FFMPEG_SECONDS = Histogram("bot_ffmpeg_seconds", "Wall time of ffmpeg/ffprobe runs, by job.", ("job", "tool"))
+FFMPEG_CPU_SECONDS = Histogram("bot_ffmpeg_cpu_seconds", "CPU time (user+sys) of ffmpeg/ffprobe runs, by job.", ("job", "tool"))
+MEDIA_QUEUE_WAIT_SECONDS = Histogram("bot_media_queue_wait_seconds", "Time media jobs spend queued before a worker starts them.", ("job",))
+
+def _upstream_prefixes():
+    telegram_api = (telebot.apihelper.API_URL or "https://api.telegram.org/bot").split("{")[0]
+    telegram_files = (telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot").split("{")[0]
+    return [(telegram_api, "telegram"), (telegram_files, "telegram_files"), (GEOCODING_URL, "open_meteo"),
+            (FORECAST_URL, "open_meteo"), (UNSPLASH_URL, "unsplash")]
+
+def upstream_service(url):
+    for prefix, service in _upstream_prefixes():
+        if url.startswith(prefix):
+            # Long polls would swamp the Bot API latency numbers
+            return "telegram_poll" if service == "telegram" and "/getUpdates" in url else service
+    return "other"
+
+class InstrumentedSession(requests.Session):
+    """requests.Session that records latency and errors per upstream service."""
+
+    def request(self, method, url, *args, **kwargs):
+        service = upstream_service(url)
+        started = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except Exception:
+            UPSTREAM_ERRORS.inc(service)
+            raise
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, service)
+        if response.status_code >= 400:
+            UPSTREAM_ERRORS.inc(service)
+        return response
+
+METRICS = [
+    HANDLER_SECONDS, UPSTREAM_SECONDS, UPSTREAM_ERRORS, FFMPEG_SECONDS, FFMPEG_CPU_SECONDS, MEDIA_QUEUE_WAIT_SECONDS,
+    CallbackMetric("bot_media_queue_depth", "Media jobs waiting for a worker.", lambda: media_jobs.depth() if media_jobs else 0),
+    CallbackMetric("bot_update_queue_depth", "Webhook updates waiting for a handler worker.",
+                   lambda: update_ingress.depth() if update_ingress else 0),
+    CallbackMetric("bot_llm_inflight", "LLM requests in flight.", lambda: llm.inflight if llm else 0),
+    CallbackMetric("bot_async_tasks", "Conversations in flight on the asyncio engine.", lambda: async_engine.tasks if async_engine else 0),
+    CallbackMetric("bot_active_users", "User sessions held in memory.", lambda: len(user_states)),
+    CallbackMetric("bot_output_cache_total", "Rendered media output cache lookups by result.",
+                   lambda: {"hit": output_cache.hits, "disk_hit": output_cache.disk_hits, "miss": output_cache.misses},
+                   label="result", kind="counter"),
+    CallbackMetric("bot_process_resident_memory_bytes", "Resident set size of the bot process.", process_rss_bytes),
+]
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
 
 # --- HELPER FUNCTIONS ---
 
-def get_groq_client():
-    return openai.OpenAI(
-        api_key=GROQ_API_KEY or "dummy_key",
-        base_url="https://api.groq.com/openai/v1"
-    )
+def make_http_session():
+    session = InstrumentedSession()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# One pooled session shared by all upstream calls (keeps connections + TLS sessions alive)
+http = make_http_session()
+
+# Bot API sends wait for their turn per chat and overall in the outbound dispatcher.
+# In sharded mode OUTBOUND_GLOBAL_RATE is already this worker's share. Per-chat limits
+# stay whole: shards are picked by user, so a private chat lives on one shard.
+# The router only calls setWebhook, so it sends directly.
+outbound = OutboundDispatcher(http, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE, OUTBOUND_GLOBAL_RATE,
+                              OUTBOUND_MAX_RETRIES, OUTBOUND_MAX_RETRY_WAIT, OUTBOUND_MAX_WAIT) if HANDLES_UPDATES else None
+METRICS.extend([
+    OUTBOUND_MERGED, OUTBOUND_THROTTLED,
+    CallbackMetric("bot_outbound_queue_depth", "Bot API sends waiting for their turn.", lambda: outbound.waiting if outbound else 0),
+])
+# Bot API calls go through the pooled session too, so they are pooled and measured the same way
+telebot.apihelper.CUSTOM_REQUEST_SENDER = outbound.request if outbound else http.request
+
+geocode_cache = TTLCache(GEOCODE_CACHE_SIZE, GEOCODE_CACHE_TTL)
+weather_cache = TTLCache(WEATHER_CACHE_SIZE, WEATHER_CACHE_TTL)
+
+def normalize_text(text):
+    """Cache key form of user input: lowercased, trimmed, single-spaced."""
+    return " ".join(text.lower().split())
+
+def fetch_json(url, params, headers=None):
+    res = http.get(url, params=params, headers=headers, timeout=HTTP_TIMEOUT)
+    res.raise_for_status()
+    return res.json()
+
+# Request/response shapes of the upstream lookups, shared by the thread and asyncio engines
+
+def _geocode_request(key):
+    return GEOCODING_URL, {"name": key, "count": 1, "language": "en", "format": "json"}
+
+def _geocode_result(data):
+    results = data.get("results")
+    return results[0] if results else None
+
+def _weather_key(lat, lon):
+    # ~1 km grid, plenty for a weather reading
+    return round(lat, 2), round(lon, 2)
+
+def _weather_request(key):
+    return FORECAST_URL, {"latitude": key[0], "longitude": key[1], "current_weather": "true"}
+
+def _image_request(key):
+    # Key goes in a header: request URLs end up in error messages and logs
+    return (UNSPLASH_URL, {"query": key, "per_page": IMAGE_FETCH_SIZE},
+            {"Authorization": f"Client-ID {UNSPLASH_ACCESS_KEY}"})
+
+def _image_result(data):
+    results = data.get("results")
+    return [{"id": r["id"], "url": r["urls"]["regular"]} for r in results] if results else None
+
+def geocode(location):
+    """Look up a place by name; returns the first Open-Meteo result or None."""
+    key = normalize_text(location)
+    if not key:
+        return None
+    return geocode_cache.get_or_load(key, lambda: _geocode_result(fetch_json(*_geocode_request(key))))
+
+def current_weather(lat, lon):
+    key = _weather_key(lat, lon)
+    return weather_cache.get_or_load(key, lambda: fetch_json(*_weather_request(key))["current_weather"])
+
+image_search_cache = TTLCache(IMAGE_CACHE_SIZE, IMAGE_CACHE_TTL)
+photo_file_ids = TTLCache(IMAGE_CACHE_SIZE * IMAGE_FETCH_SIZE, 30 * 24 * 3600)  # Unsplash id -> Telegram file_id
+
+def search_images(topic):
+    """Unsplash results for a topic as [{"id", "url"}], or None if nothing was found."""
+    key = normalize_text(topic)
+    return image_search_cache.get_or_load(key, lambda: _image_result(fetch_json(*_image_request(key))))
+
+# --- LLM GATEWAY ---
+# Every LLM call goes through one long-lived client with a global concurrency
+# cap, Retry-After aware retries, token budgets and a fallback model.
+
+class LLMUnavailable(Exception):
+    """Raised with a user-facing message when a request can't be served right now."""
+
+class TokenBudget:
+    """Fixed-window token counters per key (user or model)."""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.windows = {}  # key -> [window_start, used]
+        self.lock = threading.Lock()
+
+    def _entry(self, key, now):
+        entry = self.windows.get(key)
+        if entry is None or now - entry[0] >= self.window:
+            if len(self.windows) > 10000:
+                self.windows = {k: v for k, v in self.windows.items() if now - v[0] < self.window}
+            entry = self.windows[key] = [now, 0]
+        return entry
+
+    def exhausted(self, key):
+        if not self.limit:
+            return False
+        with self.lock:
+            return self._entry(key, time.monotonic())[1] >= self.limit
+
+    def spend(self, key, tokens):
+        with self.lock:
+            self._entry(key, time.monotonic())[1] += tokens
+
+def _retry_after(error):
+    """Seconds the API asked us to wait, if it said."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+def count_tokens(text):
+    """Cheap token estimate (~4 characters per token for English text)."""
+    return len(text) // 4 + 1
+
+class LLMGateway:
+    def __init__(self):
+        limits = httpx.Limits(max_connections=LLM_MAX_CONCURRENCY * 2, max_keepalive_connections=LLM_MAX_CONCURRENCY)
+        self.client = openai.OpenAI(
+            api_key=GROQ_API_KEY or "dummy_key",
+            base_url=GROQ_BASE_URL,
+            max_retries=0,  # retries are handled here so we can honour Retry-After and fall back
+            timeout=60,
+            http_client=httpx.Client(limits=limits),
+        )
+        # Same settings for the asyncio engine; slots and budgets are shared with the threads
+        self.aclient = openai.AsyncOpenAI(
+            api_key=GROQ_API_KEY or "dummy_key",
+            base_url=GROQ_BASE_URL,
+            max_retries=0,
+            timeout=60,
+            http_client=httpx.AsyncClient(limits=limits),
+        ) if ENGINE == "asyncio" else None
+        self.slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+        self.user_budget = TokenBudget(LLM_USER_TOKENS_PER_HOUR, 3600)
+        self.model_budget = TokenBudget(LLM_MODEL_TOKENS_PER_MINUTE, 60)
+        self.cooldown = {}  # model -> monotonic time until which it is rate limited
+        self.inflight = 0
+
+    def _saturated(self, model):
+        return self.cooldown.get(model, 0) > time.monotonic() or self.model_budget.exhausted(model)
+
+    def _pick_model(self):
+        if LLM_FALLBACK_MODEL and self._saturated(LLM_MODEL) and not self._saturated(LLM_FALLBACK_MODEL):
+            return LLM_FALLBACK_MODEL
+        return LLM_MODEL
+
+    def _create(self, model, messages, stream, kwargs):
+        started = time.perf_counter()
+        try:
+            # For streams this measures time to response headers
+            return self.client.chat.completions.create(model=model, messages=messages, stream=stream, **kwargs)
+        except openai.OpenAIError:
+            UPSTREAM_ERRORS.inc("groq")
+            raise
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, "groq")
+
+    async def _create_async(self, model, messages, stream, kwargs):
+        started = time.perf_counter()
+        try:
+            return await self.aclient.chat.completions.create(model=model, messages=messages, stream=stream, **kwargs)
+        except openai.OpenAIError:
+            UPSTREAM_ERRORS.inc("groq")
+            raise
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, "groq")
+
+    def _check_budget(self, user_id):
+        if self.user_budget.exhausted(user_id):
+            raise LLMUnavailable("You've chatted a lot this hour! 🌙 Please take a little break and try again later. ✨")
+
+    def _retry_plan(self, model, error, attempt):
+        """After a failed call: returns (model to use next, seconds to wait first), or raises."""
+        if isinstance(error, openai.RateLimitError):
+            wait = _retry_after(error)
+            self.cooldown[model] = time.monotonic() + (wait or 5)
+            if LLM_FALLBACK_MODEL and model != LLM_FALLBACK_MODEL and not self._saturated(LLM_FALLBACK_MODEL):
+                return LLM_FALLBACK_MODEL, 0
+            if attempt == LLM_MAX_RETRIES or (wait or 0) > LLM_MAX_RETRY_WAIT:
+                raise LLMUnavailable("I'm getting lots of questions right now! 😿 Please try again in a minute. ✨") from error
+        elif attempt == LLM_MAX_RETRIES:
+            raise error
+        else:
+            wait = None
+        # Jittered exponential backoff, at least as long as the server asked for
+        return model, min(LLM_MAX_RETRY_WAIT, max(wait or 0, random.uniform(0, 0.5 * 2 ** attempt)))
+
+    def _request(self, user_id, messages, stream, kwargs):
+        """Create a completion with retries; returns (model, completion or stream)."""
+        self._check_budget(user_id)
+        if not self.slots.acquire(timeout=LLM_SLOT_TIMEOUT):
+            raise LLMUnavailable("I'm getting lots of questions right now! 😿 Please try again in a few seconds. ✨")
+        try:
+            model = kwargs.pop("model", None) or self._pick_model()
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                try:
+                    completion = self._create(model, messages, stream, kwargs)
+                    self.inflight += 1
+                    return model, completion
+                except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                    model, wait = self._retry_plan(model, e, attempt)
+                if wait:
+                    time.sleep(wait)
+            raise LLMUnavailable("I'm getting lots of questions right now! 😿 Please try again in a minute. ✨")
+        except BaseException:
+            self.slots.release()
+            raise
+
+    async def _acquire_slot_async(self):
+        # The slots are shared with the thread engine, so poll rather than block the loop
+        deadline = time.monotonic() + LLM_SLOT_TIMEOUT
+        while not self.slots.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    async def _request_async(self, user_id, messages, stream, kwargs):
+        """_request for the asyncio engine."""
+        self._check_budget(user_id)
+        if not await self._acquire_slot_async():
+            raise LLMUnavailable("I'm getting lots of questions right now! 😿 Please try again in a few seconds. ✨")
+        try:
+            model = kwargs.pop("model", None) or self._pick_model()
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                try:
+                    completion = await self._create_async(model, messages, stream, kwargs)
+                    self.inflight += 1
+                    return model, completion
+                except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                    model, wait = self._retry_plan(model, e, attempt)
+                if wait:
+                    await asyncio.sleep(wait)
+            raise LLMUnavailable("I'm getting lots of questions right now! 😿 Please try again in a minute. ✨")
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def _spend(self, user_id, model, tokens):
+        self.user_budget.spend(user_id, tokens)
+        self.model_budget.spend(model, tokens)
+
+    def complete(self, user_id, messages, **kwargs):
+        """Return the full reply text."""
+        model, completion = self._request(user_id, messages, False, kwargs)
+        try:
+            text = completion.choices[0].message.content or ""
+            usage = completion.usage
+            self._spend(user_id, model, usage.total_tokens if usage else count_tokens(str(messages) + text))
+            return text
+        finally:
+            self.inflight -= 1
+            self.slots.release()
+
+    def stream(self, user_id, messages, **kwargs):
+        """Yield the reply text in chunks as they arrive."""
+        model, completion = self._request(user_id, messages, True, kwargs)
+        text = ""
+        usage = None
+        try:
+            for chunk in completion:
+                usage = getattr(chunk, "usage", None) or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    yield chunk.choices[0].delta.content
+        finally:
+            self.inflight -= 1
+            self.slots.release()
+            self._spend(user_id, model, usage.total_tokens if usage else count_tokens(str(messages) + text))
+
+    async def complete_async(self, user_id, messages, **kwargs):
+        model, completion = await self._request_async(user_id, messages, False, kwargs)
+        try:
+            text = completion.choices[0].message.content or ""
+            usage = completion.usage
+            self._spend(user_id, model, usage.total_tokens if usage else count_tokens(str(messages) + text))
+            return text
+        finally:
+            self.inflight -= 1
+            self.slots.release()
+
+    async def stream_async(self, user_id, messages, **kwargs):
+        model, completion = await self._request_async(user_id, messages, True, kwargs)
+        text = ""
+        usage = None
+        try:
+            async for chunk in completion:
+                usage = getattr(chunk, "usage", None) or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    yield chunk.choices[0].delta.content
+        finally:
+            self.inflight -= 1
+            self.slots.release()
+            self._spend(user_id, model, usage.total_tokens if usage else count_tokens(str(messages) + text))
+
+llm = LLMGateway() if HANDLES_UPDATES else None
 
 def update_state(user_id, **kwargs):
-    str_id = str(user_id)
-    if str_id not in user_states:
-        user_states[str_id] = {"mode": "normal", "dream_history": []}
-    user_states[str_id].update(kwargs)
+    user_states.update(str(user_id), **kwargs)
+
+def reset_state(user_id, **kwargs):
+    user_states.reset(str(user_id), **kwargs)
+
+def append_state(user_id, key, *items, limit=None):
+    user_states.append(str(user_id), key, *items, limit=limit)
+
+def modify_state(user_id, fn):
+    user_states.modify(str(user_id), fn)
 
 def get_state(user_id):
-    return user_states.get(str(user_id), {"mode": "normal", "dream_history": []})
+    return user_states.get(str(user_id))
+
+def split_point(text, limit):
+    """Where to cut text so the first part fits in limit, preferring paragraph/line/word breaks."""
+    if len(text) <= limit:
+        return len(text)
+    for sep in ("\n\n", "\n", " "):
+        cut = text.rfind(sep, limit // 2, limit)
+        if cut != -1:
+            return cut + len(sep)
+    return limit
+
+class StreamingReply:
+    """Shows an LLM reply as it streams in.
+
+    The first message is posted as soon as text arrives and is then edited at
+    most once per STREAM_EDIT_INTERVAL to stay under Telegram's edit limits.
+    Text past the 4096-character limit continues in follow-up messages.
+    """
+
+    def __init__(self, chat_id, min_interval=STREAM_EDIT_INTERVAL):
+        self.chat_id = chat_id
+        self.min_interval = min_interval
+        self.text = ""
+        self.start = 0  # offset in self.text where the current message begins
+        self.message_id = None
+        self.shown = ""  # what the current message displays right now
+        self.last_edit = 0.0
+
+    def feed(self, delta):
+        self.text += delta
+        self._flush(final=False)
+
+    def finish(self):
+        self._flush(final=True)
+        return self.text
+
+    def _flush(self, final):
+        for text, is_final in self._updates(final):
+            self._show(text, is_final)
+
+    def _updates(self, final):
+        """Yields (text, final) for each send/edit needed to display the text so far."""
+        if not final and self.message_id is not None and time.monotonic() - self.last_edit < self.min_interval:
+            return
+        while True:
+            chunk = self.text[self.start:]
+            if len(chunk) <= TELEGRAM_MAX_MESSAGE:
+                break
+            # Current message is full: finalize it and continue in a new one
+            cut = split_point(chunk, TELEGRAM_MAX_MESSAGE)
+            yield chunk[:cut].rstrip(), True
+            self.start += cut
+            while self.start < len(self.text) and self.text[self.start].isspace():
+                self.start += 1
+            self.message_id = None
+            self.shown = ""
+        chunk = chunk.rstrip()
+        if chunk and chunk != self.shown:
+            yield chunk, final
+
+    def _show(self, text, final):
+        if text == self.shown:
+            return
+        try:
+            if self.message_id is None:
+                with unmerged():  # this message is edited as the reply grows
+                    self.message_id = bot.send_message(self.chat_id, text).message_id
+            else:
+                bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+            self.shown = text
+        except telebot.apihelper.ApiTelegramException as e:
+            # An intermediate edit can be skipped; the next one carries the full text anyway
+            if final or self.message_id is None:
+                raise
+            print(f"Stream edit skipped: {e}")
+        self.last_edit = time.monotonic()
+
+def send_long_message(chat_id, text):
+    """Send text, split across messages if it's over Telegram's length limit."""
+    reply = StreamingReply(chat_id)
+    reply.text = text
+    return reply.finish()
+
+def reply_with_completion(chat_id, user_id, messages, **kwargs):
+    """Run a chat completion and deliver it to the chat; returns the full reply text."""
+    if not LLM_STREAMING:
+        return send_long_message(chat_id, llm.complete(str(user_id), messages, **kwargs))
+    reply = StreamingReply(chat_id)
+    for delta in llm.stream(str(user_id), messages, **kwargs):
+        reply.feed(delta)
+    return reply.finish()
+
+# --- MATH ENGINE ---
+# The solver lives in math_engine.py; answers (local or LLM) are cached by the
+# normalized expression.
+
+math_cache = TTLCache(MATH_CACHE_SIZE, MATH_CACHE_TTL)
+
+# --- CONVERSATION CONTEXT ---
+# Keeps per-request prompts flat: recent turns are sent verbatim up to a token
+# budget, older turns are folded into a running summary in the background.
+
+def _turn_text(turn):
+    if isinstance(turn, dict):
+        return f"{turn['role']}: {turn['content']}"
+    return str(turn)
+
+class ConversationContext:
+    def __init__(self, history_key, summary_key, description, budget=CONTEXT_TOKEN_BUDGET):
+        self.history_key = history_key
+        self.summary_key = summary_key
+        self.description = description
+        self.budget = budget
+        self.pending = set()  # users with a summary in progress
+        self.lock = threading.Lock()
+
+    def build(self, user_id, state):
+        """Return (summary, recent_turns) for a prompt, scheduling a summary of anything older."""
+        turns = state.get(self.history_key, [])
+        used, keep = 0, 0
+        for turn in reversed(turns):
+            used += count_tokens(_turn_text(turn))
+            if used > self.budget:
+                break
+            keep += 1
+        older = turns[:len(turns) - keep]
+        if older:
+            self._schedule(str(user_id), older, state.get(self.summary_key, ""))
+        return state.get(self.summary_key, ""), turns[len(turns) - keep:]
+
+    def _schedule(self, user_id, older, summary):
+        with self.lock:
+            if user_id in self.pending:
+                return
+            self.pending.add(user_id)
+        summary_pool.submit(self._summarize, user_id, older, summary)
+
+    def _summarize(self, user_id, older, summary):
+        try:
+            transcript = "\n".join(_turn_text(turn) for turn in older)
+            new_summary = llm.complete(user_id, [
+                {"role": "system", "content": f"You maintain a running summary of {self.description}. "
+                                              f"Merge the new turns into the existing summary. Keep names, facts, preferences, "
+                                              f"recurring themes and open threads. Reply with the summary only, under {SUMMARY_MAX_TOKENS * 3 // 4} words."},
+                {"role": "user", "content": f"Existing summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"},
+            ], model=LLM_FALLBACK_MODEL or LLM_MODEL, max_tokens=SUMMARY_MAX_TOKENS, temperature=0.2)
+
+            def fold(state):
+                # Only if nothing reset the conversation in the meantime
+                turns = state.get(self.history_key, [])
+                if turns[:len(older)] == older:
+                    state[self.history_key] = turns[len(older):]
+                    state[self.summary_key] = new_summary.strip()
+
+            modify_state(user_id, fold)
+        except Exception as e:
+            print(f"Summary error: {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(user_id)
+
+summary_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summarizer")
+chat_context = ConversationContext("chat_history", "chat_summary", "a friendly chat between a user and an assistant")
+dream_context = ConversationContext("dream_history", "dream_summary", "the dreams a user has told a dream-storyteller")
+
+# --- ADMISSION CONTROL ---
+# Token buckets per user and for the whole bot. Cheap actions (menus, time)
+# cost little, LLM calls and ffmpeg encodes cost a lot. When a bucket is
+# empty the update is answered with a quick "busy" reply instead of queueing.
+
+SHED_TOTAL = Counter("bot_shed_total", "Updates turned away by admission control.", ("action", "reason"))
+METRICS.append(SHED_TOTAL)
+
+rate_limiter = RateLimiter(USER_RATE, USER_BURST, GLOBAL_RATE, GLOBAL_BURST)
+
+def text_action(mode):
+    if mode in ("ai_chat", "dreamriddle", "math"):
+        return "llm"
+    if mode in ("weather", "images"):
+        return "lookup"
+    return "cheap"
+
+def callback_action(data):
+    if data.startswith("opt_"):
+        return "preview"
+    return "media" if data.startswith(("full_", "vid_")) else "cheap"
+
+def admit(user_id, action):
+    """Seconds the user should wait before trying again, or 0 if the update may proceed."""
+    # Don't pile more work onto a saturated subsystem. Checked before the buckets
+    # so users aren't charged for updates our own load turns away
+    if action == "llm" and llm.inflight >= LLM_MAX_CONCURRENCY:
+        SHED_TOTAL.inc(action, "llm_saturated")
+        return 5
+    if action in ("media", "preview") and media_jobs.depth() >= MEDIA_QUEUE_SIZE:
+        SHED_TOTAL.inc(action, "media_queue_full")
+        return 30
+    wait = rate_limiter.admit(str(user_id), ACTION_COSTS[action])
+    if wait:
+        SHED_TOTAL.inc(action, "rate_limit")
+        return wait
+    return 0
+
+def busy_text(wait):
+    return f"⏳ I'm a bit busy, try again in {max(1, math.ceil(wait))}s. ✨"
 
 # --- KEYBOARDS ---
 
@@ -61,19 +837,33 @@ def get_back_menu():
     markup.row("🔙 Back")
     return markup
 
+MORE_IMAGES = "➕ More images"
+
+def get_images_menu():
+    markup = ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.row(MORE_IMAGES)
+    markup.row("🔙 Back")
+    return markup
+
 # --- CORE HANDLERS ---
 
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     user_id = message.from_user.id
-    user_states[str(user_id)] = {"mode": "normal"}
+    wait = admit(user_id, "cheap")
+    if wait:
+        bot.send_message(message.chat.id, busy_text(wait))
+        return
+    reset_state(user_id)
     bot.send_message(message.chat.id, "Welcome! Choose an option:", reply_markup=get_main_menu())
 
 @bot.message_handler(func=lambda msg: msg.text == "🔙 Back")
 def handle_back(message):
     user_id = str(message.from_user.id)
     # Reset state to normal but keep history if you prefer
-    user_states[user_id] = {"mode": "normal", "dream_history": []}
+    reset_state(user_id)
+    if media_jobs.cancel_user(user_id):
+        bot.send_message(message.chat.id, "Cancelled your media processing. 🛑")
     bot.send_message(message.chat.id, "Main Menu:", reply_markup=get_main_menu())
 
 @bot.message_handler(content_types=['text'])
@@ -87,6 +877,21 @@ def handle_text(message):
     state = get_state(user_id)
     mode = state.get("mode")
 
+    wait = admit(user_id, text_action(mode))
+    if wait:
+        bot.send_message(chat_id, busy_text(wait))
+        return
+
+    if async_engine and mode in ASYNC_MODES:
+        # Upstream waits happen on the event loop instead of holding this thread
+        if not async_engine.submit(dispatch_text_async(chat_id, user_id, text, state, mode)):
+            bot.send_message(chat_id, busy_text(5))
+        return
+
+    with Timer(HANDLER_SECONDS, "text", mode or "normal"):
+        dispatch_text(chat_id, user_id, text, state, mode)
+
+def dispatch_text(chat_id, user_id, text, state, mode):
     # --- 1. HANDLE ACTIVE INPUT MODES ---
     
     if mode == "weather" or mode == "time":
@@ -95,12 +900,15 @@ def handle_text(message):
         return
 
     if mode == "images":
-        handle_image_request(chat_id, text)
-        bot.send_message(chat_id, "Enter another topic or press Back. ✨🌸", reply_markup=get_back_menu())
+        if text == MORE_IMAGES:
+            handle_more_images(chat_id, user_id, state)
+        else:
+            handle_image_request(chat_id, user_id, text)
+        bot.send_message(chat_id, "Enter another topic, tap More or press Back. ✨🌸", reply_markup=get_images_menu())
         return
 
     if mode == "math":
-        handle_math_request(chat_id, text)
+        handle_math_request(chat_id, user_id, text)
         bot.send_message(chat_id, "Enter another math problem or press Back. 🧮✨", reply_markup=get_back_menu())
         return
     
@@ -109,7 +917,7 @@ def handle_text(message):
         return
 
     if mode == "dreamriddle":
-        handle_dream_riddle(chat_id, text, state)
+        handle_dream_riddle(chat_id, user_id, text, state)
         return
 
     # --- 2. HANDLE MAIN MENU SELECTIONS ---
@@ -127,7 +935,7 @@ def handle_text(message):
         bot.send_message(chat_id, "What kind of images are you looking for today? ✨🌸", reply_markup=get_back_menu())
 
     elif text == "🤖 AI Chat":
-        update_state(user_id, mode="ai_chat", chat_history=[])
+        update_state(user_id, mode="ai_chat", chat_history=[], chat_summary="")
         bot.send_message(chat_id, "You are now chatting with AI. Say hi! (Press Back to exit)", reply_markup=get_back_menu())
 
     elif text == "🧮 Math":
@@ -144,13 +952,15 @@ def handle_text(message):
         bot.send_message(chat_id, "Please send me a video file and I'll convert it to a GIF for you! 📹✨", reply_markup=get_back_menu())
 
     elif text == "🎵 Music Edit":
-        # Music Edit still uses the Web App link provided in original code
+        update_state(user_id, mode="music_edit")
+        bot.send_message(chat_id, "Send me a song and pick an effect: I'll play you a quick preview first! 🎵✨", reply_markup=get_back_menu())
+        # The Sonic Lab web app stays available for full editing
         markup = InlineKeyboardMarkup()
         markup.add(InlineKeyboardButton("🎵 Open Sonic Lab", web_app=WebAppInfo("https://sonic-lab--usage1133.replit.app/")))
-        bot.send_message(chat_id, "Click the button below to open the Sonic Lab Music Editor: 🎵\n\nLink for browser: https://sonic-lab--usage1133.replit.app/", reply_markup=markup)
+        bot.send_message(chat_id, "Want the full editor instead? Open Sonic Lab: 🎵\n\nLink for browser: https://sonic-lab--usage1133.replit.app/", reply_markup=markup)
 
     elif text == "🌀 Dreamriddle":
-        update_state(user_id, mode="dreamriddle", dream_history=[])
+        update_state(user_id, mode="dreamriddle", dream_history=[], dream_summary="")
         bot.send_message(chat_id, "░░🌫️░░ Hello… stranger.\nWhat did you dream about? 🌙", reply_markup=get_back_menu())
 
     elif text == "🎮 Play Game":
@@ -181,86 +991,112 @@ def handle_text(message):
         bot.send_message(chat_id, "Stay updated with the latest news! 📰", reply_markup=markup)
 
 # --- LOGIC IMPLEMENTATIONS ---
+# Message texts and prompts live in small builders so the asyncio engine
+# below says exactly the same things.
+
+def location_reply(result, mode, current=None):
+    """Reply for a time lookup, or a weather lookup given its current conditions."""
+    name, country = result["name"], result["country"]
+    timezone_str = result.get("timezone", "UTC")
+
+    if mode == "time":
+        try:
+            tz = pytz.timezone(timezone_str)
+            time_str = datetime.now(tz).strftime("%m/%d/%Y, %I:%M:%S %p")
+        except:
+            time_str = datetime.now().strftime("%m/%d/%Y, %I:%M:%S %p") + " (UTC)"
+        return f"✨ Current local time in {name}, {country} ({timezone_str}): ✨\n\n⏰ {time_str} 🌸💖"
+
+    return (f"🌈 Weather in {name}, {country}: 🌈\n\n"
+            f"🌡️ Temperature: {current['temperature']}°C ✨\n"
+            f"💨 Wind Speed: {current['windspeed']} km/h 🌸\n"
+            f"✨ Condition: {current['weathercode']} 💖")
 
 def handle_location_request(chat_id, location, mode):
     try:
-        geo_res = requests.get(f"https://geocoding-api.open-meteo.com/v1/search?name={location}&count=1&language=en&format=json").json()
+        result = geocode(location)
         
-        if not geo_res.get("results"):
+        if not result:
             bot.send_message(chat_id, "Location not found. Please try again.")
             return
 
-        result = geo_res["results"][0]
-        lat, lon = result["latitude"], result["longitude"]
-        name, country = result["name"], result["country"]
-        timezone_str = result.get("timezone", "UTC")
-
-        if mode == "time":
-            try:
-                tz = pytz.timezone(timezone_str)
-                time_str = datetime.now(tz).strftime("%m/%d/%Y, %I:%M:%S %p")
-            except:
-                time_str = datetime.now().strftime("%m/%d/%Y, %I:%M:%S %p") + " (UTC)"
-            
-            bot.send_message(chat_id, f"✨ Current local time in {name}, {country} ({timezone_str}): ✨\n\n⏰ {time_str} 🌸💖")
-
-        else:
-            weather_res = requests.get(f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current_weather=true").json()
-            current = weather_res["current_weather"]
-            bot.send_message(chat_id, 
-                f"🌈 Weather in {name}, {country}: 🌈\n\n"
-                f"🌡️ Temperature: {current['temperature']}°C ✨\n"
-                f"💨 Wind Speed: {current['windspeed']} km/h 🌸\n"
-                f"✨ Condition: {current['weathercode']} 💖"
-            )
+        current = current_weather(result["latitude"], result["longitude"]) if mode != "time" else None
+        bot.send_message(chat_id, location_reply(result, mode, current))
     except Exception as e:
         print(f"Location error: {e}")
         bot.send_message(chat_id, f"Failed to fetch {mode} data.")
 
-def handle_image_request(chat_id, topic):
+def image_album(topic, batch, use_file_ids):
+    caption = f"Here are {len(batch)} cute images of \"{topic}\" for you! ✨💖🌸"
+    return [InputMediaPhoto((use_file_ids and photo_file_ids.get(p["id"])) or p["url"], caption=caption if i == 0 else None)
+            for i, p in enumerate(batch)]
+
+def remember_photo_ids(batch, messages):
+    for photo, message in zip(batch, messages):
+        if message.photo:
+            photo_file_ids.set(photo["id"], message.photo[-1].file_id)
+
+def send_image_page(chat_id, topic, photos, page):
+    """Send one page of photos as a single album, reusing file_ids of photos we've sent before."""
+    batch = photos[page * IMAGE_PAGE_SIZE:(page + 1) * IMAGE_PAGE_SIZE]
+    try:
+        messages = bot.send_media_group(chat_id, image_album(topic, batch, True))
+    except telebot.apihelper.ApiTelegramException as e:
+        # A stale file_id fails the whole album; retry straight from the URLs
+        print(f"Album with cached file_ids failed: {e}")
+        messages = bot.send_media_group(chat_id, image_album(topic, batch, False))
+    remember_photo_ids(batch, messages)
+
+def handle_image_request(chat_id, user_id, topic):
     bot.send_chat_action(chat_id, "upload_photo")
     try:
         if not UNSPLASH_ACCESS_KEY:
             bot.send_message(chat_id, "Unsplash API key is missing! 😿✨")
             return
         
-        res = requests.get(f"https://api.unsplash.com/search/photos?query={topic}&per_page=3&client_id={UNSPLASH_ACCESS_KEY}").json()
+        photos = search_images(topic)
         
-        if "errors" in res or not res.get("results"):
+        if not photos:
             bot.send_message(chat_id, f"I couldn't find any images for \"{topic}\". 😿✨")
             return
 
-        for result in res["results"]:
-            bot.send_photo(chat_id, result["urls"]["regular"])
-        
-        bot.send_message(chat_id, f"Here are 3 cute images of \"{topic}\" for you! ✨💖🌸")
-    except Exception:
+        send_image_page(chat_id, topic, photos, 0)
+        update_state(user_id, image_topic=topic, image_page=0)
+    except Exception as e:
+        print(f"Image error: {e}")
         bot.send_message(chat_id, "Failed to fetch images. 😿✨")
 
-def handle_math_request(chat_id, problem):
-    bot.send_chat_action(chat_id, "typing")
+def handle_more_images(chat_id, user_id, state):
+    topic = state.get("image_topic")
+    if not topic:
+        bot.send_message(chat_id, "Tell me a topic first! ✨🌸")
+        return
+    bot.send_chat_action(chat_id, "upload_photo")
     try:
-        client = get_groq_client()
-        completion = client.chat.completions.create(
-            model="groq/compound-mini", # Adjust model name if specific Groq model needed (e.g., llama3-8b-8192)
-            messages=[
-                {"role": "system", "content": "You are a brilliant math expert with a cute and friendly vibe. Solve the math problem provided clearly and step-by-step. You can handle everything from basic arithmetic to complex calculus, trigonometry, multiple variables, and imaginary numbers. Use lots of emojis and be very encouraging! ✨🌸💖"},
-                {"role": "user", "content": f"Please solve this math problem: {problem}"}
-            ]
-        )
-        reply = completion.choices[0].message.content
-        bot.send_message(chat_id, reply)
+        photos = search_images(topic) or []
+        page = state.get("image_page", 0) + 1
+        if page * IMAGE_PAGE_SIZE >= len(photos):
+            bot.send_message(chat_id, f"That's all the \"{topic}\" images I have! Try another topic. ✨🌸")
+            return
+
+        send_image_page(chat_id, topic, photos, page)
+        update_state(user_id, image_page=page)
     except Exception as e:
-        print(f"Math error: {e}")
-        bot.send_message(chat_id, "Sorry, my math brain is a bit fuzzy right now. 😿✨")
+        print(f"Image error: {e}")
+        bot.send_message(chat_id, "Failed to fetch images. 😿✨")
 
-def handle_dream_riddle(chat_id, text, state):
-    bot.send_chat_action(chat_id, "typing")
-    try:
-        client = get_groq_client()
-        history = " | ".join(state.get("dream_history", [])) or "None"
-        
-        prompt = f"""You are Dreamriddle / Imago Narrator Bot, a mysterious, liminal AI storyteller.
+def math_messages(problem):
+    return [
+        {"role": "system", "content": "You are a brilliant math expert with a cute and friendly vibe. Solve the math problem provided clearly and step-by-step. You can handle everything from basic arithmetic to complex calculus, trigonometry, multiple variables, and imaginary numbers. Use lots of emojis and be very encouraging! ✨🌸💖"},
+        {"role": "user", "content": f"Please solve this math problem: {problem}"}
+    ]
+
+def dream_messages(text, summary, recent):
+    history = " | ".join(recent) or "None"
+    if summary:
+        history = f"{summary} | Recently: {history}"
+
+    prompt = f"""You are Dreamriddle / Imago Narrator Bot, a mysterious, liminal AI storyteller.
 Your purpose is to take a user's dream, emotion, or prompt and transform it into a short, immersive story.
 RULES:
 1. Tone adaptation (Horror, Peaceful, Surreal, Melancholic, Liminal, Whimsical).
@@ -268,54 +1104,767 @@ RULES:
 3. Déjà Vu: Include subtle hints of future events.
 4. Ending: End every story with a ONE-WORD question.
 5. Context: Current: {text}. History: {history}"""
+    return [{"role": "system", "content": prompt}, {"role": "user", "content": text}]
+
+def chat_messages(text, summary, recent):
+    system = "You are a helpful assistant with a cute and friendly vibe. Use lots of emojis in your responses and be very polite and cheerful! ✨🌸💖"
+    if summary:
+        system += f"\n\nSummary of the conversation so far: {summary}"
+    messages = [{"role": "system", "content": system}]
+    messages.extend(recent)
+    messages.append({"role": "user", "content": text})
+    return messages
+
+def handle_math_request(chat_id, user_id, problem):
+    key = math_cache_key(problem)
+    answer = math_cache.get(key) or solve_locally(problem)
+    if answer:
+        math_cache.set(key, answer)
+        send_long_message(chat_id, answer)
+        return
 
-        completion = client.chat.completions.create(
-            model="groq/compound-mini",
-            messages=[{"role": "system", "content": prompt}, {"role": "user", "content": text}]
-        )
-        reply = completion.choices[0].message.content
+    bot.send_chat_action(chat_id, "typing")
+    try:
+        answer = reply_with_completion(chat_id, user_id, messages=math_messages(problem))
+        if answer:
+            math_cache.set(key, answer)
+    except LLMUnavailable as e:
+        bot.send_message(chat_id, str(e))
+    except Exception as e:
+        print(f"Math error: {e}")
+        bot.send_message(chat_id, "Sorry, my math brain is a bit fuzzy right now. 😿✨")
+
+def handle_dream_riddle(chat_id, user_id, text, state):
+    bot.send_chat_action(chat_id, "typing")
+    try:
+        summary, recent = dream_context.build(user_id, state)
+        reply_with_completion(chat_id, user_id, messages=dream_messages(text, summary, recent))
         
-        state["dream_history"].append(text)
-        bot.send_message(chat_id, reply)
+        append_state(user_id, "dream_history", text, limit=CONTEXT_MAX_TURNS)
+    except LLMUnavailable as e:
+        bot.send_message(chat_id, str(e))
     except Exception:
         bot.send_message(chat_id, "░░🌫️░░ The dream slips away... Again?")
 
 def handle_ai_chat(chat_id, user_id, text, state):
     bot.send_chat_action(chat_id, "typing")
     try:
-        chat_history = state.get("chat_history", [])
-        messages = [{"role": "system", "content": "You are a helpful assistant with a cute and friendly vibe. Use lots of emojis in your responses and be very polite and cheerful! ✨🌸💖"}]
-        messages.extend(chat_history)
-        messages.append({"role": "user", "content": text})
-
-        client = get_groq_client()
-        completion = client.chat.completions.create(
-            model="groq/compound-mini",
-            messages=messages,
+        summary, recent = chat_context.build(user_id, state)
+        reply = reply_with_completion(
+            chat_id, user_id,
+            messages=chat_messages(text, summary, recent),
             max_tokens=1024,
             temperature=0.7
         )
-        reply = completion.choices[0].message.content
         
-        chat_history.append({"role": "user", "content": text})
-        chat_history.append({"role": "assistant", "content": reply})
-        state["chat_history"] = chat_history[-10:] # Keep last 10 messages
-        
-        bot.send_message(chat_id, reply)
+        append_state(user_id, "chat_history",
+                     {"role": "user", "content": text},
+                     {"role": "assistant", "content": reply},
+                     limit=CONTEXT_MAX_TURNS)
+    except LLMUnavailable as e:
+        bot.send_message(chat_id, str(e))
     except Exception:
         bot.send_message(chat_id, "Sorry, I'm having trouble thinking right now. 😿✨")
 
+# --- ASYNC ENGINE ---
+# With ENGINE=asyncio the I/O-bound text modes run as coroutines on one event
+# loop: lookups go through httpx's async client, LLM calls through the
+# gateway's async methods and replies through telebot's async bot. Updates
+# still arrive through the threaded bot, whose handler just hands the
+# conversation over. ffmpeg work stays on the media job workers.
+
+ASYNC_MODES = ("weather", "time", "images", "math", "ai_chat", "dreamriddle")
+
+class AsyncEngine:
+    def __init__(self, max_tasks):
+        # Needs aiohttp, so only imported when this engine is picked
+        from telebot.async_telebot import AsyncTeleBot
+        from telebot import asyncio_helper
+        if TELEGRAM_API_URL:
+            asyncio_helper.API_URL = telebot.apihelper.API_URL
+            asyncio_helper.FILE_URL = telebot.apihelper.FILE_URL
+        asyncio_helper._process_request = outbound.wrap_async(asyncio_helper._process_request)
+        self.bot = AsyncTeleBot(TOKEN)
+        self.api_error = asyncio_helper.ApiTelegramException
+        self.http = httpx.AsyncClient(timeout=HTTP_TIMEOUT,
+                                      limits=httpx.Limits(max_connections=HTTP_POOL_SIZE * 4, max_keepalive_connections=HTTP_POOL_SIZE))
+        self.max_tasks = max_tasks
+        self.tasks = 0
+        self.lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="async-engine", daemon=True).start()
+
+    def submit(self, coro):
+        """Schedule a coroutine from any thread; returns False (dropping it) if the loop is full."""
+        with self.lock:
+            if self.tasks >= self.max_tasks:
+                coro.close()
+                return False
+            self.tasks += 1
+        asyncio.run_coroutine_threadsafe(coro, self.loop).add_done_callback(self._done)
+        return True
+
+    def _done(self, future):
+        with self.lock:
+            self.tasks -= 1
+        if not future.cancelled() and future.exception():
+            print(f"Async handler error: {future.exception()}")
+
+    def drain(self, timeout):
+        """Wait until no coroutines are in flight; returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while self.tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    async def fetch_json(self, url, params, headers=None):
+        service = upstream_service(url)
+        started = time.perf_counter()
+        try:
+            res = await self.http.get(url, params=params, headers=headers)
+            res.raise_for_status()
+        except Exception:
+            UPSTREAM_ERRORS.inc(service)
+            raise
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, service)
+        return res.json()
+
+async def geocode_async(location):
+    key = normalize_text(location)
+    if not key:
+        return None
+
+    async def load():
+        return _geocode_result(await async_engine.fetch_json(*_geocode_request(key)))
+
+    return await geocode_cache.get_or_load_async(key, load)
+
+async def current_weather_async(lat, lon):
+    key = _weather_key(lat, lon)
+
+    async def load():
+        return (await async_engine.fetch_json(*_weather_request(key)))["current_weather"]
+
+    return await weather_cache.get_or_load_async(key, load)
+
+async def search_images_async(topic):
+    key = normalize_text(topic)
+
+    async def load():
+        return _image_result(await async_engine.fetch_json(*_image_request(key)))
+
+    return await image_search_cache.get_or_load_async(key, load)
+
+class AsyncStreamingReply(StreamingReply):
+    """StreamingReply that sends through the async bot."""
+
+    async def feed(self, delta):
+        self.text += delta
+        await self._flush(final=False)
+
+    async def finish(self):
+        await self._flush(final=True)
+        return self.text
+
+    async def _flush(self, final):
+        for text, is_final in self._updates(final):
+            await self._show(text, is_final)
+
+    async def _show(self, text, final):
+        if text == self.shown:
+            return
+        try:
+            if self.message_id is None:
+                with unmerged():
+                    self.message_id = (await async_engine.bot.send_message(self.chat_id, text)).message_id
+            else:
+                await async_engine.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+            self.shown = text
+        except async_engine.api_error as e:
+            if final or self.message_id is None:
+                raise
+            print(f"Stream edit skipped: {e}")
+        self.last_edit = time.monotonic()
+
+async def send_long_message_async(chat_id, text):
+    reply = AsyncStreamingReply(chat_id)
+    reply.text = text
+    return await reply.finish()
+
+async def reply_with_completion_async(chat_id, user_id, messages, **kwargs):
+    if not LLM_STREAMING:
+        return await send_long_message_async(chat_id, await llm.complete_async(str(user_id), messages, **kwargs))
+    reply = AsyncStreamingReply(chat_id)
+    async for delta in llm.stream_async(str(user_id), messages, **kwargs):
+        await reply.feed(delta)
+    return await reply.finish()
+
+async def dispatch_text_async(chat_id, user_id, text, state, mode):
+    """dispatch_text for the ASYNC_MODES, run on the event loop."""
+    abot = async_engine.bot
+    with Timer(HANDLER_SECONDS, "text_async", mode):
+        if mode in ("weather", "time"):
+            await handle_location_request_async(chat_id, text, mode)
+            await abot.send_message(chat_id, "Enter another location or press Back.", reply_markup=get_back_menu())
+        elif mode == "images":
+            if text == MORE_IMAGES:
+                await handle_more_images_async(chat_id, user_id, state)
+            else:
+                await handle_image_request_async(chat_id, user_id, text)
+            await abot.send_message(chat_id, "Enter another topic, tap More or press Back. ✨🌸", reply_markup=get_images_menu())
+        elif mode == "math":
+            await handle_math_request_async(chat_id, user_id, text)
+            await abot.send_message(chat_id, "Enter another math problem or press Back. 🧮✨", reply_markup=get_back_menu())
+        elif mode == "ai_chat":
+            await handle_ai_chat_async(chat_id, user_id, text, state)
+        elif mode == "dreamriddle":
+            await handle_dream_riddle_async(chat_id, user_id, text, state)
+
+async def handle_location_request_async(chat_id, location, mode):
+    abot = async_engine.bot
+    try:
+        result = await geocode_async(location)
+        if not result:
+            await abot.send_message(chat_id, "Location not found. Please try again.")
+            return
+
+        current = await current_weather_async(result["latitude"], result["longitude"]) if mode != "time" else None
+        await abot.send_message(chat_id, location_reply(result, mode, current))
+    except Exception as e:
+        print(f"Location error: {e}")
+        await abot.send_message(chat_id, f"Failed to fetch {mode} data.")
+
+async def send_image_page_async(chat_id, topic, photos, page):
+    batch = photos[page * IMAGE_PAGE_SIZE:(page + 1) * IMAGE_PAGE_SIZE]
+    try:
+        messages = await async_engine.bot.send_media_group(chat_id, image_album(topic, batch, True))
+    except async_engine.api_error as e:
+        print(f"Album with cached file_ids failed: {e}")
+        messages = await async_engine.bot.send_media_group(chat_id, image_album(topic, batch, False))
+    remember_photo_ids(batch, messages)
+
+async def handle_image_request_async(chat_id, user_id, topic):
+    abot = async_engine.bot
+    await abot.send_chat_action(chat_id, "upload_photo")
+    try:
+        if not UNSPLASH_ACCESS_KEY:
+            await abot.send_message(chat_id, "Unsplash API key is missing! 😿✨")
+            return
+
+        photos = await search_images_async(topic)
+        if not photos:
+            await abot.send_message(chat_id, f"I couldn't find any images for \"{topic}\". 😿✨")
+            return
+
+        await send_image_page_async(chat_id, topic, photos, 0)
+        update_state(user_id, image_topic=topic, image_page=0)
+    except Exception as e:
+        print(f"Image error: {e}")
+        await abot.send_message(chat_id, "Failed to fetch images. 😿✨")
+
+async def handle_more_images_async(chat_id, user_id, state):
+    abot = async_engine.bot
+    topic = state.get("image_topic")
+    if not topic:
+        await abot.send_message(chat_id, "Tell me a topic first! ✨🌸")
+        return
+    await abot.send_chat_action(chat_id, "upload_photo")
+    try:
+        photos = await search_images_async(topic) or []
+        page = state.get("image_page", 0) + 1
+        if page * IMAGE_PAGE_SIZE >= len(photos):
+            await abot.send_message(chat_id, f"That's all the \"{topic}\" images I have! Try another topic. ✨🌸")
+            return
+
+        await send_image_page_async(chat_id, topic, photos, page)
+        update_state(user_id, image_page=page)
+    except Exception as e:
+        print(f"Image error: {e}")
+        await abot.send_message(chat_id, "Failed to fetch images. 😿✨")
+
+async def handle_math_request_async(chat_id, user_id, problem):
+    abot = async_engine.bot
+    key = math_cache_key(problem)
+    # The local solver is CPU work, keep it off the loop
+    answer = math_cache.get(key) or await asyncio.get_running_loop().run_in_executor(None, solve_locally, problem)
+    if answer:
+        math_cache.set(key, answer)
+        await send_long_message_async(chat_id, answer)
+        return
+
+    await abot.send_chat_action(chat_id, "typing")
+    try:
+        answer = await reply_with_completion_async(chat_id, user_id, messages=math_messages(problem))
+        if answer:
+            math_cache.set(key, answer)
+    except LLMUnavailable as e:
+        await abot.send_message(chat_id, str(e))
+    except Exception as e:
+        print(f"Math error: {e}")
+        await abot.send_message(chat_id, "Sorry, my math brain is a bit fuzzy right now. 😿✨")
+
+async def handle_dream_riddle_async(chat_id, user_id, text, state):
+    abot = async_engine.bot
+    await abot.send_chat_action(chat_id, "typing")
+    try:
+        summary, recent = dream_context.build(user_id, state)
+        await reply_with_completion_async(chat_id, user_id, messages=dream_messages(text, summary, recent))
+        append_state(user_id, "dream_history", text, limit=CONTEXT_MAX_TURNS)
+    except LLMUnavailable as e:
+        await abot.send_message(chat_id, str(e))
+    except Exception:
+        await abot.send_message(chat_id, "░░🌫️░░ The dream slips away... Again?")
+
+async def handle_ai_chat_async(chat_id, user_id, text, state):
+    abot = async_engine.bot
+    await abot.send_chat_action(chat_id, "typing")
+    try:
+        summary, recent = chat_context.build(user_id, state)
+        reply = await reply_with_completion_async(
+            chat_id, user_id,
+            messages=chat_messages(text, summary, recent),
+            max_tokens=1024,
+            temperature=0.7
+        )
+        append_state(user_id, "chat_history",
+                     {"role": "user", "content": text},
+                     {"role": "assistant", "content": reply},
+                     limit=CONTEXT_MAX_TURNS)
+    except LLMUnavailable as e:
+        await abot.send_message(chat_id, str(e))
+    except Exception:
+        await abot.send_message(chat_id, "Sorry, I'm having trouble thinking right now. 😿✨")
+
+async_engine = AsyncEngine(ASYNC_MAX_TASKS) if ENGINE == "asyncio" and HANDLES_UPDATES else None
+
+# --- MEDIA JOBS ---
+# ffmpeg work runs on its own bounded worker pool so text handlers never wait on encodes
+
+class TelegramDownloadError(Exception):
+    pass
+
+def run_media_job(job):
+    MEDIA_QUEUE_WAIT_SECONDS.observe(time.monotonic() - job.queued_at, job.label)
+    job.deadline = time.monotonic() + MEDIA_JOB_TIMEOUT
+    try:
+        job.check()
+        with Timer(HANDLER_SECONDS, "media", job.label):
+            job.func(job, *job.args)
+    except JobCancelled:
+        pass
+    except JobTimeout:
+        bot.send_message(job.chat_id, "Sorry, that file took too long to process. ⏳😿 Try a shorter one!")
+    except Exception as e:
+        print(f"Media job error: {e}")
+
+def _limit_ffmpeg_cpu(pid):
+    # Set from outside after spawning: preexec_fn isn't safe in a process with this many threads
+    if hasattr(resource, "prlimit"):
+        try:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (MEDIA_JOB_CPU_LIMIT, MEDIA_JOB_CPU_LIMIT + 5))
+        except (OSError, ValueError) as e:
+            print(f"Couldn't limit ffmpeg CPU time: {e}")
+
+# Containers ffmpeg can decode from a non-seekable pipe (MP4/M4A need to seek to the moov atom)
+PIPEABLE_AUDIO_TYPES = {"audio/mpeg", "audio/mp3", "audio/ogg", "audio/flac", "audio/x-flac", "audio/wav", "audio/x-wav"}
+
+def telegram_file_url(file_path):
+    return (telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(TOKEN, file_path)
+
+def iter_telegram_file(job, file_path):
+    """Download a Telegram file in DOWNLOAD_CHUNK_SIZE pieces without holding it in memory."""
+    # The file URL embeds the bot token and requests puts it in its error messages,
+    # so only the status code or error type escapes into our logs
+    try:
+        with http.get(telegram_file_url(file_path), stream=True, timeout=HTTP_TIMEOUT) as res:
+            if not res.ok:
+                raise TelegramDownloadError(f"file download failed with HTTP {res.status_code}")
+            for chunk in res.iter_content(DOWNLOAD_CHUNK_SIZE):
+                job.check()
+                yield chunk
+    except requests.RequestException as e:
+        raise TelegramDownloadError(f"file download failed ({type(e).__name__})") from None
+
+def spool_telegram_file(job, file_path, path):
+    with open(path, 'wb') as f:
+        for chunk in iter_telegram_file(job, file_path):
+            f.write(chunk)
+
+def audio_input(job, file_id, mime_type, temp_dir):
+    """ffmpeg input for an uploaded track: (input argument, stdin chunks or None)."""
+    file_info = bot.get_file(file_id)
+    # Stream straight into ffmpeg when the format allows it, otherwise spool to disk in chunks
+    if mime_type in PIPEABLE_AUDIO_TYPES:
+        return 'pipe:0', iter_telegram_file(job, file_info.file_path)
+    path = os.path.join(temp_dir, "input")
+    spool_telegram_file(job, file_info.file_path, path)
+    return path, None
+
+class DecodedSources:
+    """Uploads decoded to WAV, kept for a few minutes so trying several effects
+    downloads and decodes the track only once.
+
+    acquire()/add() hold an entry until release(), so a file in use by ffmpeg is
+    never evicted. Tracks without a file_unique_id aren't cached.
+    """
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.directory = None  # created on first use
+        self.entries = OrderedDict()  # unique_id -> [expires_at, path, size, holders]
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, unique_id):
+        """Path of the cached decode, held until release(), or None."""
+        with self.lock:
+            self._expire()
+            entry = self.entries.get(unique_id) if unique_id else None
+            if entry is None:
+                return None
+            entry[0] = time.monotonic() + self.ttl
+            entry[3] += 1
+            self.entries.move_to_end(unique_id)
+            return entry[1]
+
+    def add(self, unique_id, path):
+        """Adopt a freshly decoded file; returns its cached path, held like acquire()."""
+        if not unique_id:
+            return path
+        with self.lock:
+            if unique_id in self.entries:
+                # Someone else decoded the same track meanwhile; use theirs
+                entry = self.entries[unique_id]
+                entry[3] += 1
+                return entry[1]
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="decoded-")
+                atexit.register(shutil.rmtree, self.directory, True)
+            target = os.path.join(self.directory, hashlib.sha1(unique_id.encode()).hexdigest() + ".wav")
+            shutil.move(path, target)
+            size = os.path.getsize(target)
+            self.entries[unique_id] = [time.monotonic() + self.ttl, target, size, 1]
+            self.bytes += size
+            self._expire()
+            return target
+
+    def release(self, unique_id):
+        with self.lock:
+            entry = self.entries.get(unique_id) if unique_id else None
+            if entry:
+                entry[3] -= 1
+            self._expire()
+
+    def _expire(self):
+        now = time.monotonic()
+        for unique_id, (expires_at, path, size, holders) in list(self.entries.items()):
+            if holders == 0 and (expires_at < now or self.bytes > self.max_bytes):
+                del self.entries[unique_id]
+                self.bytes -= size
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            if self.directory:
+                shutil.rmtree(self.directory, True)
+                self.directory = None
+
+    def __len__(self):
+        return len(self.entries)
+
+decoded_sources = DecodedSources(DECODED_CACHE_TTL, DECODED_CACHE_MAX_BYTES)
+
+def _feed_stdin(pipe, chunks, errors):
+    try:
+        for chunk in chunks:
+            pipe.write(chunk)
+    except (BrokenPipeError, ValueError):
+        pass  # ffmpeg exited (or was killed) before reading everything
+    except Exception as e:
+        errors.append(e)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()  # releases the download connection early
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+def _wait_with_usage(proc, timeout):
+    """Wait for proc, killing it after timeout; returns (timed_out, rusage or None)."""
+    if not hasattr(os, "wait4"):
+        try:
+            proc.wait(timeout=timeout)
+            return False, None
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            return True, None
+    expired = threading.Event()
+
+    def expire():
+        expired.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, expire)
+    timer.start()
+    try:
+        # wait4 reaps the child ourselves so we get its own CPU usage
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    except ChildProcessError:
+        # Reaped by a concurrent poll() (e.g. from job.cancel); returncode is already set
+        usage = None
+        proc.wait()
+    finally:
+        timer.cancel()
+    return expired.is_set(), usage
+
+def run_ffmpeg(job, cmd, stdin_chunks=None, capture_stdout=False):
+    """Run ffmpeg (or ffprobe) for a job, honouring its cancellation and wall-clock deadline.
+
+    If stdin_chunks is given, it is streamed into ffmpeg's stdin (use 'pipe:0' as input).
+    Returns stdout when capture_stdout is set.
+    """
+    job.check()
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if stdin_chunks is not None else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _limit_ffmpeg_cpu(proc.pid)
+    job.proc = proc
+    stdout, stderr, feed_errors = [], [], []
+    threads = [threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True)]
+    if capture_stdout:
+        threads.append(threading.Thread(target=lambda: stdout.append(proc.stdout.read()), daemon=True))
+    if stdin_chunks is not None:
+        threads.append(threading.Thread(target=_feed_stdin, args=(proc.stdin, stdin_chunks, feed_errors), daemon=True))
+    for t in threads:
+        t.start()
+    started = time.perf_counter()
+    try:
+        if job.cancelled.is_set():
+            proc.kill()
+        timed_out, usage = _wait_with_usage(proc, job.remaining())
+        tool = os.path.basename(cmd[0])
+        FFMPEG_SECONDS.observe(time.perf_counter() - started, job.label, tool)
+        if usage:
+            FFMPEG_CPU_SECONDS.observe(usage.ru_utime + usage.ru_stime, job.label, tool)
+        if timed_out:
+            raise JobTimeout()
+    finally:
+        job.proc = None
+        for t in threads:
+            t.join(timeout=5)
+    job.check()
+    if feed_errors:
+        # A truncated download can still look like a successful encode
+        raise feed_errors[0]
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=b"".join(stderr))
+    return b"".join(stdout)
+
+def enqueue_media_job(chat_id, user_id, func, *args, label="media", dedupe_key=None, priority=1):
+    try:
+        position = media_jobs.submit(user_id, chat_id, func, *args, label=label, dedupe_key=dedupe_key, priority=priority)
+    except MediaDuplicate:
+        return  # repeated tap on a job that's already queued or running
+    except MediaUserLimit:
+        bot.send_message(chat_id, "You already have files waiting to be processed. Please wait for them to finish! ⏳✨")
+        return
+    except MediaQueueFull:
+        bot.send_message(chat_id, "I'm busy with lots of files right now. 😿 Please try again in a minute! ✨")
+        return
+    if position:
+        bot.send_message(chat_id, f"You are #{position} in queue ⏳✨ (press Back to cancel)")
+
+media_jobs = (MediaJobQueue(MEDIA_WORKERS, MEDIA_QUEUE_SIZE, MEDIA_JOBS_PER_USER, MEDIA_QUEUED_PER_USER, run_media_job)
+              if HANDLES_UPDATES else None)
+
+# --- OUTPUT CACHE ---
+# Rendered audio/GIFs keyed by (source file_unique_id, effect, option, pipeline
+# version). A hit is re-sent by Telegram file_id: no download, ffmpeg or upload.
+
+def sent_file_id(message):
+    # Animations also carry a document, which is what send_document expects back
+    for kind in ("audio", "document", "animation", "video", "voice"):
+        media = getattr(message, kind, None)
+        if media:
+            return media.file_id
+    return None
+
+class OutputCache:
+    def __init__(self, max_entries, ttl, directory=None, max_bytes=0):
+        self.file_ids = TTLCache(max_entries, ttl)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # digest -> [path, size], least recently used first. Files keep the render's
+        # extension: Telegram shows the uploaded name and sniffs the type from it
+        self.files = OrderedDict()
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            entries = [os.path.join(directory, name) for name in os.listdir(directory)]
+            for path in sorted(entries, key=os.path.getmtime):
+                digest, ext = os.path.splitext(os.path.basename(path))
+                if not ext:  # written before extensions were kept
+                    self._remove(path)
+                    continue
+                self.files[digest] = [path, os.path.getsize(path)]
+                self.disk_bytes += self.files[digest][1]
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def send(self, key, send_fn, count_miss=True):
+        """Deliver a cached render with send_fn(file); returns False on a miss."""
+        if key[0] is None:  # source unknown, nothing safe to reuse
+            return False
+        file_id = self.file_ids.get(key)
+        if file_id:
+            try:
+                send_fn(file_id)
+                self.hits += 1
+                return True
+            except telebot.apihelper.ApiTelegramException as e:
+                print(f"Cached file_id rejected: {e}")
+                self.file_ids.pop(key)
+        if self.directory:
+            digest = self._digest(key)
+            with self.lock:
+                entry = self.files.get(digest)
+                if entry:
+                    self.files.move_to_end(digest)
+            if entry:
+                try:
+                    with open(entry[0], 'rb') as f:
+                        message = send_fn(f)
+                    self.disk_hits += 1
+                    self.file_ids.set(key, sent_file_id(message))
+                    return True
+                except OSError:
+                    with self.lock:
+                        if self.files.get(digest) is entry:
+                            del self.files[digest]
+                            self.disk_bytes -= entry[1]
+        if count_miss:
+            self.misses += 1
+        return False
+
+    def store(self, key, message, path=None):
+        """Remember what we just sent for key, keeping a copy of path on disk if enabled."""
+        if key[0] is None:
+            return
+        file_id = sent_file_id(message)
+        if file_id:
+            self.file_ids.set(key, file_id)
+        if not (self.directory and path):
+            return
+        digest = self._digest(key)
+        target = os.path.join(self.directory, digest + os.path.splitext(path)[1])
+        try:
+            shutil.copyfile(path, target)
+            size = os.path.getsize(target)
+        except OSError as e:
+            print(f"Output cache write failed: {e}")
+            return
+        evicted = []
+        with self.lock:
+            old = self.files.pop(digest, None)
+            if old:
+                self.disk_bytes -= old[1]
+                if old[0] != target:
+                    evicted.append(old[0])
+            self.files[digest] = [target, size]
+            self.disk_bytes += size
+            while self.disk_bytes > self.max_bytes and len(self.files) > 1:
+                old_path, old_size = self.files.popitem(last=False)[1]
+                self.disk_bytes -= old_size
+                evicted.append(old_path)
+        for old_path in evicted:
+            self._remove(old_path)
+
+    def stats(self):
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "entries": len(self.file_ids), "disk_files": len(self.files), "disk_bytes": self.disk_bytes}
+
+output_cache = OutputCache(OUTPUT_CACHE_SIZE, OUTPUT_CACHE_TTL, OUTPUT_CACHE_DIR, OUTPUT_CACHE_MAX_BYTES)
+
+def audio_output_key(unique_id, effect, option):
+    return (unique_id, effect, option, PIPELINE_VERSION)
+
+def audio_preview_key(unique_id, effect, option):
+    return audio_output_key(unique_id, effect, option) + ("preview", PREVIEW_SECONDS)
+
+def audio_caption(effect, option):
+    return f"Effect applied: {effect} ({option}) 🎵✨🌸"
+
+def audio_preview_caption(effect, option):
+    return f"Preview of {effect} ({option}) 🎧✨ Like it? Tap below for the whole song!"
+
+def source_tag(unique_id):
+    """Short id of an upload for callback data (Telegram allows 64 bytes)."""
+    return hashlib.sha1((unique_id or "").encode()).hexdigest()[:8]
+
+def full_track_markup(unique_id, effect, option):
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("🎚️ Render full track", callback_data=f"full_{source_tag(unique_id)}_{effect}_{option}"))
+    return markup
+
+def preview_offset(duration):
+    """Where the preview starts: a third of the way in, leaving room for a full excerpt."""
+    if not duration or duration <= PREVIEW_SECONDS:
+        return 0
+    return min(duration // 3, duration - PREVIEW_SECONDS)
+
+def video_output_key(unique_id, output_format):
+    return (unique_id, output_format, "default", PIPELINE_VERSION)
+
+VIDEO_CAPTIONS = {
+    "gif": "Here is your GIF! 📹✨🌸",
+    "animation": "Here is your animation! 📹✨🌸",
+}
+
+def send_video_output(chat_id, output_format, file):
+    if output_format == "animation":
+        return bot.send_animation(chat_id, file, caption=VIDEO_CAPTIONS[output_format])
+    return bot.send_document(chat_id, file, caption=VIDEO_CAPTIONS[output_format])
+
 # --- MEDIA HANDLERS (Music & Video) ---
 
 @bot.message_handler(content_types=['audio'])
 def handle_audio(message):
     user_id = str(message.from_user.id)
     chat_id = message.chat.id
+    wait = admit(user_id, "cheap")
+    if wait:
+        bot.send_message(chat_id, busy_text(wait))
+        return
     state = get_state(user_id)
     
     # Auto-detect if user is in Music Edit mode
     if state.get("mode") == "music_edit":
-        update_state(user_id, audio_file_id=message.audio.file_id)
+        update_state(user_id, audio_file_id=message.audio.file_id, audio_unique_id=message.audio.file_unique_id,
+                     audio_mime=message.audio.mime_type, audio_duration=message.audio.duration)
         
         markup = InlineKeyboardMarkup()
         markup.row(InlineKeyboardButton("Slow", callback_data="effect_slow"), InlineKeyboardButton("Bass Boost", callback_data="effect_bass"))
@@ -326,11 +1875,26 @@ def handle_audio(message):
 
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callbacks(call):
+    wait = admit(call.from_user.id, callback_action(call.data))
+    if wait:
+        bot.answer_callback_query(call.id, busy_text(wait))
+        return
+    with Timer(HANDLER_SECONDS, "callback", bounded_label(call.data.split("_")[0], CALLBACK_KINDS)):
+        dispatch_callback(call)
+
+CALLBACK_KINDS = ("vid", "effect", "opt", "full")
+AUDIO_EFFECTS = ("slow", "bass", "bit", "galaxy", "rain", "deffect")
+
+def dispatch_callback(call):
     chat_id = call.message.chat.id
     user_id = str(call.from_user.id)
     data = call.data
     state = get_state(user_id)
 
+    if data.startswith("vid_"):
+        handle_video_choice(call, state)
+        return
+
     if not state.get("audio_file_id"):
         bot.answer_callback_query(call.id, "Please send the music file first! 🎵")
         return
@@ -361,67 +1925,162 @@ def handle_callbacks(call):
 
         bot.edit_message_text(f"Select options for {effect}:", chat_id=chat_id, message_id=call.message.message_id, reply_markup=markup)
 
-    # 2. PROCESS AUDIO
+    # 2. PREVIEW THE EFFECT
     elif data.startswith("opt_"):
         option = data.replace("opt_", "")
+        effect = state["selected_effect"]
+        unique_id = state.get("audio_unique_id")
+        # Already rendered in full? Then there's nothing to preview
+        if output_cache.send(audio_output_key(unique_id, effect, option),
+                             lambda f: bot.send_audio(chat_id, f, caption=audio_caption(effect, option)), count_miss=False):
+            bot.answer_callback_query(call.id, "Here you go! ✨")
+            return
+        key = audio_preview_key(unique_id, effect, option)
+        if media_jobs.is_active(user_id, key):
+            bot.answer_callback_query(call.id, "Already working on that one! ⏳")
+            return
+        if output_cache.send(key, lambda f: send_audio_preview(chat_id, f, unique_id, effect, option)):
+            bot.answer_callback_query(call.id, "Here's a preview! 🎧")
+            return
+        bot.answer_callback_query(call.id, "Rendering a quick preview... 🎧✨")
+        enqueue_media_job(chat_id, user_id, process_audio_preview, chat_id, state["audio_file_id"], state.get("audio_mime"), key, effect, option,
+                          preview_offset(state.get("audio_duration")), label=f"preview_{bounded_label(effect, AUDIO_EFFECTS)}", dedupe_key=key, priority=0)
+
+    # 3. RENDER THE FULL TRACK
+    elif data.startswith("full_"):
+        _, tag, effect, option = data.split("_", 3)
+        unique_id = state.get("audio_unique_id")
+        if tag != source_tag(unique_id):
+            bot.answer_callback_query(call.id, "That preview is for an older song. Pick the effect again! 🎵")
+            return
+        key = audio_output_key(unique_id, effect, option)
+        if media_jobs.is_active(user_id, key):
+            bot.answer_callback_query(call.id, "Already working on that one! ⏳")
+            return
+        if output_cache.send(key, lambda f: bot.send_audio(chat_id, f, caption=audio_caption(effect, option))):
+            bot.answer_callback_query(call.id, "Here you go! ✨")
+            return
         bot.answer_callback_query(call.id, "Processing your request... ⚙️✨")
-        process_audio(chat_id, state["audio_file_id"], state["selected_effect"], option)
+        enqueue_media_job(chat_id, user_id, process_audio, chat_id, state["audio_file_id"], state.get("audio_mime"), key, effect, option,
+                          label=f"audio_{bounded_label(effect, AUDIO_EFFECTS)}", dedupe_key=key)
+
+def send_audio_preview(chat_id, file, unique_id, effect, option):
+    return bot.send_audio(chat_id, file, caption=audio_preview_caption(effect, option),
+                          reply_markup=full_track_markup(unique_id, effect, option))
+
+def audio_effect_args(effect, option):
+    """ffmpeg filter (or, for Bit Booster, bitrate) arguments for an effect."""
+    if effect == "slow":
+        speed = float(option)
+        # FFmpeg 'atempo' filter is limited to 0.5 - 2.0 range, chaining needed for extremes
+        if speed < 0.5: filter_str = f"atempo=0.5,atempo={speed/0.5}"
+        elif speed > 2.0: filter_str = f"atempo=2.0,atempo={speed/2.0}"
+        else: filter_str = f"atempo={speed}"
+        return ['-filter:a', filter_str]
+
+    if effect == "bass":
+        gain = 5 if option == "low" else 10 if option == "medium" else 20
+        return ['-af', f"equalizer=f=60:width_type=h:w=50:g={gain}"]
+
+    if effect == "bit":
+        return ['-b:a', option]
+
+    if effect == "galaxy":
+        if option == "chill":
+            return ['-af', "extrastereo=m=3.0,aecho=0.8:0.9:60:0.3,lowpass=f=15000,bass=g=3"]
+        return ['-af', "aecho=0.8:0.9:1000:0.3"]
+
+    if effect == "deffect":
+        freq = 0.1 if option == "2d" else 0.2 if option == "4d" else 0.5 if option == "8d" else 1.0
+        return ['-af', f"apulsator=hz={freq}"]
+
+    if effect == "rain":
+        return ['-af', "lowpass=f=3500,highpass=f=150,aecho=0.6:0.66:400:0.2,volume=0.9"]
+
+    return []
+
+def decode_source(job, unique_id, file_id, mime_type, temp_dir):
+    """Path of the track decoded to WAV, decoding it now if it isn't cached.
+
+    The path is held in decoded_sources; release it when done.
+    """
+    path = decoded_sources.acquire(unique_id)
+    if path:
+        return path
+    input_arg, stdin_chunks = audio_input(job, file_id, mime_type, temp_dir)
+    decoded = os.path.join(temp_dir, "decoded.wav")
+    run_ffmpeg(job, ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-i', input_arg, '-vn', '-c:a', 'pcm_s16le', decoded],
+               stdin_chunks)
+    return decoded_sources.add(unique_id, decoded)
+
+def process_audio_preview(job, chat_id, file_id, mime_type, key, effect, option, offset):
+    bot.send_chat_action(chat_id, "upload_document")
+    unique_id = key[0]
+    try:
+        if output_cache.send(key, lambda f: send_audio_preview(chat_id, f, unique_id, effect, option), count_miss=False):
+            return
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = decode_source(job, unique_id, file_id, mime_type, temp_dir)
+            output_path = os.path.join(temp_dir, f"preview_{effect}.mp3")
+            try:
+                # Seek in the decoded copy and cut the output, so slowed/sped-up previews are PREVIEW_SECONDS long too
+                cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-ss', str(offset), '-i', source]
+                cmd.extend(audio_effect_args(effect, option))
+                if effect != "bit":
+                    cmd.extend(['-c:a', 'libmp3lame', '-b:a', PREVIEW_BITRATE])
+                cmd.extend(['-t', str(PREVIEW_SECONDS), output_path])
+                run_ffmpeg(job, cmd)
+            finally:
+                decoded_sources.release(unique_id)
+
+            with open(output_path, 'rb') as audio:
+                sent = send_audio_preview(chat_id, audio, unique_id, effect, option)
+            output_cache.store(key, sent, output_path)
+
+    except (JobCancelled, JobTimeout):
+        raise
+    except Exception as e:
+        print(f"Audio Preview Error: {e}")
+        bot.send_message(chat_id, "Failed to process audio. 😿✨")
 
-def process_audio(chat_id, file_id, effect, option):
+def process_audio(job, chat_id, file_id, mime_type, key, effect, option):
     bot.send_chat_action(chat_id, "upload_document")
+    unique_id = key[0]
     try:
-        file_info = bot.get_file(file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        
+        # An identical job may have finished while this one waited in the queue
+        if output_cache.send(key, lambda f: bot.send_audio(chat_id, f, caption=audio_caption(effect, option)), count_miss=False):
+            return
+
         with tempfile.TemporaryDirectory() as temp_dir:
-            input_path = os.path.join(temp_dir, "input.mp3")
             output_path = os.path.join(temp_dir, f"output_{effect}.mp3")
             
-            with open(input_path, 'wb') as f:
-                f.write(downloaded_file)
-            
             bot.send_message(chat_id, "Editing your music... 🎵⚙️")
 
-            cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-i', input_path]
-            filter_str = ""
-
-            if effect == "slow":
-                speed = float(option)
-                # FFmpeg 'atempo' filter is limited to 0.5 - 2.0 range, chaining needed for extremes
-                if speed < 0.5: filter_str = f"atempo=0.5,atempo={speed/0.5}"
-                elif speed > 2.0: filter_str = f"atempo=2.0,atempo={speed/2.0}"
-                else: filter_str = f"atempo={speed}"
-                cmd.extend(['-filter:a', filter_str])
-            
-            elif effect == "bass":
-                gain = 5 if option == "low" else 10 if option == "medium" else 20
-                cmd.extend(['-af', f"equalizer=f=60:width_type=h:w=50:g={gain}"])
-            
-            elif effect == "bit":
-                cmd.extend(['-b:a', option])
-            
-            elif effect == "galaxy":
-                if option == "chill":
-                    cmd.extend(['-af', "extrastereo=m=3.0,aecho=0.8:0.9:60:0.3,lowpass=f=15000,bass=g=3"])
+            # Previews usually left a decoded copy behind; otherwise read the upload directly
+            source = decoded_sources.acquire(unique_id)
+            try:
+                if source:
+                    input_arg, stdin_chunks = source, None
                 else:
-                    cmd.extend(['-af', "aecho=0.8:0.9:1000:0.3"])
-            
-            elif effect == "deffect":
-                freq = 0.1 if option == "2d" else 0.2 if option == "4d" else 0.5 if option == "8d" else 1.0
-                cmd.extend(['-af', f"apulsator=hz={freq}"])
-            
-            elif effect == "rain":
-                cmd.extend(['-af', "lowpass=f=3500,highpass=f=150,aecho=0.6:0.66:400:0.2,volume=0.9"])
-
-            if effect != "bit":
-                cmd.extend(['-c:a', 'libmp3lame', '-preset', 'superfast'])
-            
-            cmd.append(output_path)
-            subprocess.run(cmd, check=True)
+                    input_arg, stdin_chunks = audio_input(job, file_id, mime_type, temp_dir)
+
+                cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-i', input_arg]
+                cmd.extend(audio_effect_args(effect, option))
+                if effect != "bit":
+                    cmd.extend(['-c:a', 'libmp3lame', '-preset', 'superfast'])
+                cmd.append(output_path)
+                run_ffmpeg(job, cmd, stdin_chunks)
+            finally:
+                if source:
+                    decoded_sources.release(unique_id)
             
             with open(output_path, 'rb') as audio:
-                bot.send_audio(chat_id, audio, caption=f"Effect applied: {effect} ({option}) 🎵✨🌸")
+                sent = bot.send_audio(chat_id, audio, caption=audio_caption(effect, option))
+            output_cache.store(key, sent, output_path)
 
+    except (JobCancelled, JobTimeout):
+        raise
     except Exception as e:
         print(f"Audio Process Error: {e}")
         bot.send_message(chat_id, "Failed to process audio. 😿✨")
@@ -430,54 +2089,426 @@ def process_audio(chat_id, file_id, effect, option):
 def handle_video(message):
     chat_id = message.chat.id
     user_id = str(message.from_user.id)
+    wait = admit(user_id, "cheap")
+    if wait:
+        bot.send_message(chat_id, busy_text(wait))
+        return
     state = get_state(user_id)
 
     if state.get("mode") == "video_to_gif":
-        file_id = None
-        if message.video: file_id = message.video.file_id
+        media = None
+        if message.video: media = message.video
         elif message.document and message.document.mime_type and message.document.mime_type.startswith("video/"):
-            file_id = message.document.file_id
+            media = message.document
         
-        if file_id:
-            process_video_to_gif(chat_id, file_id)
+        if media:
+            # Telegram tells us the length of real videos, so long clips fail before any download
+            duration = getattr(media, "duration", None)
+            if duration and duration > VIDEO_MAX_SECONDS:
+                bot.send_message(chat_id, f"That clip is {duration}s long. 😿 Please send a video shorter than {VIDEO_MAX_SECONDS}s! ✨")
+                return
+            update_state(user_id, video_file_id=media.file_id, video_unique_id=media.file_unique_id)
+
+            markup = InlineKeyboardMarkup()
+            markup.row(InlineKeyboardButton("🎞️ GIF", callback_data="vid_gif"),
+                       InlineKeyboardButton("⚡ MP4 animation", callback_data="vid_animation"))
+            bot.send_message(chat_id, f"How should I convert it? 📹✨\n\n🎞️ GIF: classic, up to {GIF_MAX_SECONDS}s\n⚡ MP4 animation: plays like a GIF, much faster and smaller, up to {ANIMATION_MAX_SECONDS}s", reply_markup=markup)
+
+def handle_video_choice(call, state):
+    chat_id = call.message.chat.id
+    user_id = str(call.from_user.id)
+    output_format = call.data.replace("vid_", "")
+
+    if output_format not in VIDEO_CAPTIONS or not state.get("video_file_id"):
+        bot.answer_callback_query(call.id, "Please send the video first! 📹")
+        return
 
-def process_video_to_gif(chat_id, file_id):
+    key = video_output_key(state.get("video_unique_id"), output_format)
+    if media_jobs.is_active(user_id, key):
+        bot.answer_callback_query(call.id, "Already working on that one! ⏳")
+        return
+    if output_cache.send(key, lambda f: send_video_output(chat_id, output_format, f)):
+        bot.answer_callback_query(call.id, "Here you go! ✨")
+        return
+    bot.answer_callback_query(call.id, "Processing your request... ⚙️✨")
+    enqueue_media_job(chat_id, user_id, process_video, chat_id, state["video_file_id"], key, output_format,
+                      label=f"video_{output_format}", dedupe_key=key)
+
+def probe_video(job, path):
+    """Duration, size and frame rate of the first video stream, via ffprobe."""
+    out = run_ffmpeg(job, ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                           '-show_entries', 'stream=width,height,avg_frame_rate:format=duration',
+                           '-of', 'json', path], capture_stdout=True)
+    info = json.loads(out)
+    stream = info["streams"][0]
+    try:
+        fps = float(Fraction(stream.get("avg_frame_rate", "0/1")))
+    except (ValueError, ZeroDivisionError):
+        fps = 0.0
+    return {
+        "duration": float(info.get("format", {}).get("duration") or 0),
+        "width": int(stream["width"]),
+        "height": int(stream["height"]),
+        "fps": fps or 25.0,
+    }
+
+def gif_settings(probe):
+    """Pick trim length, fps, width and palette size so frames x pixels fits GIF_PIXEL_BUDGET.
+
+    That product drives both the GIF's size and how long palettegen/paletteuse take.
+    """
+    seconds = min(probe["duration"] or GIF_MAX_SECONDS, GIF_MAX_SECONDS)
+    aspect = probe["height"] / probe["width"]
+    fps = min(12, probe["fps"])
+    width = min(480, probe["width"])
+
+    def cost():
+        return width * width * aspect * fps * seconds
+
+    while cost() > GIF_PIXEL_BUDGET and fps > 8:
+        fps -= 1
+    while cost() > GIF_PIXEL_BUDGET and width > 240:
+        width -= 40
+    # Long, busy clips compress far better with a smaller palette
+    colors = 128 if seconds <= 8 else 64
+    return {"seconds": seconds, "fps": fps, "width": width - width % 2, "colors": colors}
+
+def video_command(input_path, output_path, output_format, probe):
+    cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error']
+    if output_format == "animation":
+        fps = min(30, probe["fps"])
+        return cmd + ['-t', str(ANIMATION_MAX_SECONDS), '-i', input_path, '-an',
+                      '-vf', f"fps={fps:g},scale='min(720,iw)':-2",
+                      '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '26', '-pix_fmt', 'yuv420p',
+                      '-movflags', '+faststart', output_path]
+    gif = gif_settings(probe)
+    return cmd + ['-t', f"{gif['seconds']:g}", '-i', input_path,
+                  '-vf', f"fps={gif['fps']:g},scale={gif['width']}:-1:flags=lanczos,split[s0][s1];"
+                         f"[s0]palettegen=max_colors={gif['colors']}:stats_mode=diff[p];[s1][p]paletteuse=dither=bayer:bayer_scale=3",
+                  '-loop', '0', output_path]
+
+def process_video(job, chat_id, file_id, key, output_format):
     bot.send_chat_action(chat_id, "upload_document")
     try:
+        if output_cache.send(key, lambda f: send_video_output(chat_id, output_format, f), count_miss=False):
+            return
         file_info = bot.get_file(file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
 
         with tempfile.TemporaryDirectory() as temp_dir:
             input_path = os.path.join(temp_dir, "input.mp4")
-            output_path = os.path.join(temp_dir, "output.gif")
-            
-            with open(input_path, 'wb') as f:
-                f.write(downloaded_file)
+            output_path = os.path.join(temp_dir, "output.mp4" if output_format == "animation" else "output.gif")
             
-            bot.send_message(chat_id, "Processing your video... ⚙️✨")
+            # MP4 needs a seekable input, so spool to disk chunk by chunk
+            spool_telegram_file(job, file_info.file_path, input_path)
+
+            probe = probe_video(job, input_path)
+            if probe["duration"] > VIDEO_MAX_SECONDS:
+                bot.send_message(chat_id, f"That clip is {probe['duration']:.0f}s long. 😿 Please send a video shorter than {VIDEO_MAX_SECONDS}s! ✨")
+                return
             
-            cmd = f'ffmpeg -y -i "{input_path}" -vf "fps=10,scale=480:-1:flags=lanczos,split[s0][s1];[s0]palettegen=max_colors=128[p];[s1][p]paletteuse=dither=bayer:bayer_scale=1" -loop 0 "{output_path}"'
-            subprocess.run(cmd, shell=True, check=True)
+            limit = ANIMATION_MAX_SECONDS if output_format == "animation" else GIF_MAX_SECONDS
+            if probe["duration"] > limit:
+                bot.send_message(chat_id, f"Processing your video... ⚙️✨ I'll keep the first {limit}s.")
+            else:
+                bot.send_message(chat_id, "Processing your video... ⚙️✨")
+            run_ffmpeg(job, video_command(input_path, output_path, output_format, probe))
             
-            with open(output_path, 'rb') as gif:
-                bot.send_document(chat_id, gif, caption="Here is your GIF! 📹✨🌸")
+            with open(output_path, 'rb') as output:
+                sent = send_video_output(chat_id, output_format, output)
+            output_cache.store(key, sent, output_path)
 
+    except (JobCancelled, JobTimeout):
+        raise
     except Exception as e:
-        print(f"Video to GIF error: {e}")
-        bot.send_message(chat_id, "Failed to convert video to GIF. 😿✨")
+        print(f"Video conversion error: {e}")
+        bot.send_message(chat_id, "Failed to convert your video. 😿✨")
 
 # --- SERVER (RENDER) ---
 
+class _DedupingIngress:
+    """Accepts raw webhook updates once each.
+
+    Telegram retries deliveries it didn't get a 200 for, so recently seen
+    update_ids are remembered and duplicates are dropped.
+    """
+
+    def __init__(self, remember=10000):
+        self.remember = remember
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def accept(self, update):
+        """Queue a raw update dict; returns False if the queue is full."""
+        update_id = update.get("update_id")
+        with self.lock:
+            if update_id in self.seen:
+                return True
+            self.seen[update_id] = None
+            while len(self.seen) > self.remember:
+                self.seen.popitem(last=False)
+        if self._put(update):
+            return True
+        # Forget it so Telegram's retry is accepted
+        with self.lock:
+            self.seen.pop(update_id, None)
+        return False
+
+def update_sender(update):
+    """User id a raw update comes from (falls back to the chat, then the update id)."""
+    for value in update.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("chat")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return update.get("update_id")
+
+class UpdateIngress(_DedupingIngress):
+    """Bounded hand-off from the webhook route to a pool of handler workers.
+
+    Updates from one sender run one at a time and in arrival order ("🧮 Math"
+    then "2+2" must see the mode set), while different senders share the pool.
+    """
+
+    def __init__(self, workers, max_queued, remember=10000):
+        super().__init__(remember)
+        self.max_queued = max_queued
+        self.pending = {}  # sender -> deque of updates; present while queued or running
+        self.ready = queue.Queue()  # senders with updates and no worker on them
+        self.queued = 0  # updates accepted and not yet handled
+        self.cond = threading.Condition(self.lock)
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"update-worker-{i}", daemon=True).start()
+
+    def _add(self, update):
+        sender = update_sender(update)
+        updates = self.pending.get(sender)
+        if updates is None:
+            self.pending[sender] = deque([update])
+            self.ready.put(sender)
+        else:
+            updates.append(update)
+        self.queued += 1
+
+    def _put(self, update):
+        with self.cond:
+            if self.queued >= self.max_queued:
+                return False
+            self._add(update)
+        return True
+
+    def put(self, update):
+        """Queue an update, waiting for room instead of refusing it."""
+        with self.cond:
+            while self.queued >= self.max_queued:
+                self.cond.wait()
+            self._add(update)
+
+    def join(self):
+        """Wait until every queued update has been handled."""
+        with self.cond:
+            while self.queued:
+                self.cond.wait()
+
+    def depth(self):
+        return self.queued
+
+    def _worker(self):
+        while True:
+            sender = self.ready.get()
+            with self.cond:
+                update = self.pending[sender].popleft()
+            try:
+                bot.process_new_updates([telebot.types.Update.de_json(update)])
+            except Exception as e:
+                print(f"Update processing error: {e}")
+            finally:
+                with self.cond:
+                    self.queued -= 1
+                    if self.pending[sender]:
+                        self.ready.put(sender)  # back of the line, so one busy sender can't hog a worker
+                    else:
+                        del self.pending[sender]
+                    self.cond.notify_all()
+
+class HashRing:
+    """Consistent hashing: changing the number of nodes only moves ~1/N of the keys."""
+
+    def __init__(self, nodes, replicas=100):
+        points = sorted((self._hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self.keys = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+    def node(self, key):
+        return self.nodes[bisect.bisect(self.keys, self._hash(key)) % len(self.keys)]
+
+class ShardRouter(_DedupingIngress):
+    """Routes webhook updates to worker processes by consistent hash of the sender.
+
+    A user always lands on the same shard, so their mode, history and media
+    jobs stay local to one process. Each shard's queue belongs to the router:
+    while a worker restarts, its updates wait in the queue for the new one.
+    """
+
+    def __init__(self, shards, max_queued, remember=10000):
+        super().__init__(remember)
+        self.ctx = multiprocessing.get_context("spawn")  # fresh interpreter, no inherited threads
+        self.ring = HashRing(range(shards))
+        self.queues = [self.ctx.Queue(max_queued) for _ in range(shards)]
+        self.procs = [self._spawn(i) for i in range(shards)]
+        self.restarting = set()
+        self.closing = False
+        threading.Thread(target=self._supervise, name="shard-supervisor", daemon=True).start()
+
+    def _spawn(self, shard):
+        proc = self.ctx.Process(target=run_shard_worker, args=(shard, self.queues[shard]), name=f"shard-{shard}")
+        proc.start()
+        return proc
+
+    def _put(self, update):
+        try:
+            self.queues[self.ring.node(update_sender(update))].put_nowait(update)
+        except queue.Full:
+            return False
+        return True
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def _stop(self, shard):
+        self.queues[shard].put(None)  # handled after everything already queued for the shard
+        proc = self.procs[shard]
+        proc.join(SHARD_DRAIN_TIMEOUT + 30)
+        if proc.is_alive():
+            print(f"Shard {shard} did not drain in time, terminating")
+            proc.terminate()
+            proc.join()
+
+    def restart(self):
+        """Rolling restart: drain and replace one worker at a time."""
+        for shard in range(len(self.procs)):
+            with self.lock:
+                if self.closing:
+                    return
+                self.restarting.add(shard)
+            try:
+                self._stop(shard)
+                self.procs[shard] = self._spawn(shard)
+            finally:
+                with self.lock:
+                    self.restarting.discard(shard)
+            print(f"Shard {shard} restarted")
+
+    def shutdown(self):
+        """Drain all workers in parallel and wait for them to exit."""
+        with self.lock:
+            self.closing = True
+        stoppers = [threading.Thread(target=self._stop, args=(shard,)) for shard in range(len(self.procs))]
+        for t in stoppers:
+            t.start()
+        for t in stoppers:
+            t.join()
+
+    def _supervise(self):
+        while True:
+            time.sleep(1)
+            with self.lock:
+                if self.closing:
+                    return
+                for shard, proc in enumerate(self.procs):
+                    if shard not in self.restarting and not proc.is_alive():
+                        print(f"Shard {shard} exited with code {proc.exitcode}, respawning")
+                        self.procs[shard] = self._spawn(shard)
+
+def run_shard_worker(shard, updates):
+    """Entry point of a shard process: handle routed updates until told to stop."""
+    # The router decides when workers stop, so they can drain first
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    ingress = UpdateIngress(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    parent = multiprocessing.parent_process()
+    print(f"Shard {shard} started (pid {os.getpid()})")
+    while True:
+        try:
+            update = updates.get(timeout=1)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                break
+            continue
+        if update is None:
+            break
+        ingress.put(update)
+    # Finish handling what was routed here, then the media jobs it started, then persist state
+    ingress.join()
+    if async_engine and not async_engine.drain(SHARD_DRAIN_TIMEOUT):
+        print(f"Shard {shard} stopping with conversations still in flight")
+    if not media_jobs.drain(SHARD_DRAIN_TIMEOUT):
+        print(f"Shard {shard} stopping with media jobs still running")
+    summary_pool.shutdown(wait=True)
+    # multiprocessing children skip atexit handlers
+    decoded_sources.clear()
+    user_states.flush()
+
+update_ingress = UpdateIngress(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE) if BOT_MODE == "webhook" else None
+
 @app.route('/')
 def index():
     return "Bot is running!"
 
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/stats')
+def stats():
+    return {"output_cache": output_cache.stats()}
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def webhook():
+    if update_ingress is None:
+        abort(404)
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        abort(403)
+    update = request.get_json(force=True, silent=True)
+    if not isinstance(update, dict):
+        abort(400)
+    if not update_ingress.accept(update):
+        # Telegram will redeliver later
+        return "Busy", 503
+    return ""
+
 def run_web_server():
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
 
+def handle_shard_signals(router):
+    """SIGHUP rolls the workers one at a time; SIGTERM drains them all and exits."""
+    def on_hup(signum, frame):
+        threading.Thread(target=router.restart, name="shard-restart", daemon=True).start()
+
+    def on_term(signum, frame):
+        router.shutdown()
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGHUP, on_hup)
+    signal.signal(signal.SIGTERM, on_term)
+
 if __name__ == "__main__":
     print("Bot is starting...")
-    t = threading.Thread(target=run_web_server)
-    t.start()
-    bot.infinity_polling()
+    if BOT_MODE == "webhook":
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+        run_web_server()
+    elif BOT_MODE == "sharded":
+        update_ingress = ShardRouter(SHARD_WORKERS, WEBHOOK_QUEUE_SIZE)
+        handle_shard_signals(update_ingress)
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+        run_web_server()
+    else:
+        t = threading.Thread(target=run_web_server)
+        t.start()
+        bot.remove_webhook()
+        bot.infinity_polling()
@@ -0,0 +1,250 @@
+"""Exact local evaluator for plain arithmetic, functions, complex numbers and
+single-variable linear/quadratic equations. Anything it can't parse goes to the LLM.
+"""
+
+import re
+import ast
+import math
+import cmath
+import operator
+from fractions import Fraction
+
+class MathError(Exception):
+    pass
+
+MATH_MAX_LENGTH = 200
+MATH_MAX_NODES = 100
+MATH_MAX_DIGITS = 1000  # largest integer result we're willing to build
+MATH_MAX_FACTORIAL = 400
+
+_MATH_PREFIX = re.compile(r"^(please\s+)?(what\s+is|what's|calculate|compute|evaluate|solve|find|simplify)\s+", re.I)
+_IMPLICIT_NUMBER = re.compile(r"(?<![a-z_\d.])(\d+(?:\.\d+)?)\s*(?=[a-z(])")
+_IMPLICIT_PAREN = re.compile(r"\)\s*(?=[a-z(\d])")
+
+def _prepare_expression(problem):
+    text = " ".join(problem.lower().split()).rstrip("?!. ")
+    text = _MATH_PREFIX.sub("", text)
+    for old, new in (("×", "*"), ("÷", "/"), ("−", "-"), ("^", "**"), ("√", "sqrt"), ("π", "pi"), ("°", "*pi/180")):
+        text = text.replace(old, new)
+    text = _IMPLICIT_NUMBER.sub(r"\1*", text)
+    return _IMPLICIT_PAREN.sub(")*", text)
+
+def math_cache_key(problem):
+    """Cache key for a problem: its prepared expression without whitespace ("what is 2 + 2" == "2+2")."""
+    return "".join(_prepare_expression(problem).split())
+
+def _as_float(x):
+    return float(x) if isinstance(x, Fraction) else x
+
+def _real_or_complex(real_fn, complex_fn):
+    def fn(x):
+        x = _as_float(x)
+        if isinstance(x, complex):
+            return complex_fn(x)
+        try:
+            return real_fn(x)
+        except ValueError:  # e.g. log(-1), asin(2)
+            return complex_fn(x)
+    return fn
+
+def _trig(real_fn, complex_fn):
+    # sin(pi) is 1.2e-16 in floats; snap such rounding noise to an exact 0, so
+    # tan(90°) and 1/cos(pi/2) become divisions by zero instead of 1.6e16
+    evaluate = _real_or_complex(real_fn, complex_fn)
+
+    def fn(x):
+        value = evaluate(x)
+        if isinstance(value, float) and abs(value) < 1e-12 * abs(_as_float(x)):
+            return 0.0
+        return value
+    return fn
+
+def _tan(x):
+    sin, cos = _MATH_FUNCTIONS["sin"](x), _MATH_FUNCTIONS["cos"](x)
+    if isinstance(sin, complex) or isinstance(cos, complex):
+        return cmath.tan(_as_float(x))
+    if cos == 0:
+        raise MathError("tan is undefined here")
+    return sin / cos
+
+def _sqrt(x):
+    if isinstance(x, (int, Fraction)) and x >= 0:
+        x = Fraction(x)
+        num, den = math.isqrt(x.numerator), math.isqrt(x.denominator)
+        if num * num == x.numerator and den * den == x.denominator:
+            return Fraction(num, den)
+    x = _as_float(x)
+    return cmath.sqrt(x) if isinstance(x, complex) or x < 0 else math.sqrt(x)
+
+def _log(x, base=None):
+    value = _real_or_complex(math.log, cmath.log)(x)
+    return value if base is None else value / _real_or_complex(math.log, cmath.log)(base)
+
+def _factorial(x):
+    if not isinstance(x, (int, Fraction)) or Fraction(x).denominator != 1 or not 0 <= x <= MATH_MAX_FACTORIAL:
+        raise MathError("factorial needs a whole number up to %d" % MATH_MAX_FACTORIAL)
+    return math.factorial(int(x))
+
+_MATH_FUNCTIONS = {
+    "sqrt": _sqrt,
+    "sin": _trig(math.sin, cmath.sin),
+    "cos": _trig(math.cos, cmath.cos),
+    "tan": _tan,
+    "asin": _real_or_complex(math.asin, cmath.asin),
+    "acos": _real_or_complex(math.acos, cmath.acos),
+    "atan": _real_or_complex(math.atan, cmath.atan),
+    "sinh": _real_or_complex(math.sinh, cmath.sinh),
+    "cosh": _real_or_complex(math.cosh, cmath.cosh),
+    "tanh": _real_or_complex(math.tanh, cmath.tanh),
+    "exp": _real_or_complex(math.exp, cmath.exp),
+    "ln": _log,
+    "log": _log,
+    "log10": _real_or_complex(math.log10, cmath.log10),
+    "log2": lambda x: _log(x, 2),
+    "abs": abs,
+    "factorial": _factorial,
+    "floor": lambda x: math.floor(_as_float(x)),
+    "ceil": lambda x: math.ceil(_as_float(x)),
+    "re": lambda x: complex(x).real,
+    "im": lambda x: complex(x).imag,
+    "conj": lambda x: complex(x).conjugate(),
+    "arg": lambda x: cmath.phase(complex(x)),
+}
+_MATH_CONSTANTS = {"pi": math.pi, "e": math.e, "tau": math.tau, "i": 1j, "j": 1j}
+_MATH_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Mod: operator.mod,
+    ast.FloorDiv: operator.floordiv,
+}
+
+def _power(base, exponent):
+    if isinstance(exponent, Fraction) and exponent.denominator == 1:
+        exponent = int(exponent)
+    if isinstance(base, (int, Fraction)) and isinstance(exponent, int):
+        size = abs(exponent) * math.log10(max(abs(base.numerator), abs(base.denominator), 2)) if isinstance(base, Fraction) \
+            else abs(exponent) * math.log10(max(abs(base), 2))
+        if size > MATH_MAX_DIGITS:
+            raise MathError("result too large")
+        return Fraction(base) ** exponent
+    base, exponent = _as_float(base), _as_float(exponent)
+    if abs(exponent) > 10000:
+        raise MathError("exponent too large")
+    return base ** exponent
+
+def _evaluate(node, variables):
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body, variables)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float, complex):
+        return node.value
+    if isinstance(node, ast.Name):
+        if node.id in variables:
+            return variables[node.id]
+        if node.id in _MATH_CONSTANTS:
+            return _MATH_CONSTANTS[node.id]
+        raise MathError(f"unknown name {node.id}")
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        value = _evaluate(node.operand, variables)
+        return -value if isinstance(node.op, ast.USub) else value
+    if isinstance(node, ast.BinOp):
+        left, right = _evaluate(node.left, variables), _evaluate(node.right, variables)
+        if isinstance(node.op, ast.Pow):
+            return _power(left, right)
+        if isinstance(node.op, ast.Div):
+            if isinstance(left, (int, Fraction)) and isinstance(right, (int, Fraction)):
+                return Fraction(left) / Fraction(right)
+            return _as_float(left) / _as_float(right)
+        if type(node.op) in _MATH_OPERATORS:
+            return _MATH_OPERATORS[type(node.op)](left, right)
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _MATH_FUNCTIONS
+            and not node.keywords and 1 <= len(node.args) <= 2):
+        return _MATH_FUNCTIONS[node.func.id](*[_evaluate(arg, variables) for arg in node.args])
+    raise MathError("unsupported expression")
+
+def _parse_expression(text):
+    if not text or len(text) > MATH_MAX_LENGTH:
+        raise MathError("expression too long")
+    try:
+        tree = ast.parse(text, mode="eval")
+    except SyntaxError as e:
+        raise MathError("not an expression") from e
+    if sum(1 for _ in ast.walk(tree)) > MATH_MAX_NODES:
+        raise MathError("expression too long")
+    return tree
+
+def _simplify(value):
+    if isinstance(value, complex):
+        if abs(value.imag) <= 1e-12 * max(1.0, abs(value.real)):
+            return _simplify(value.real)
+        return value
+    if isinstance(value, Fraction) and value.denominator == 1:
+        return int(value)
+    return value
+
+def format_number(value):
+    value = _simplify(value)
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, Fraction):
+        return f"{value.numerator}/{value.denominator} ≈ {float(value):.12g}"
+    if isinstance(value, complex):
+        real, imag = _simplify(value.real), value.imag
+        imag_str = f"{abs(imag):.12g}i" if abs(imag) != 1 else "i"
+        if real == 0:
+            return f"-{imag_str}" if imag < 0 else imag_str
+        return f"{real:.12g} {'-' if imag < 0 else '+'} {imag_str}"
+    return f"{value:.12g}"
+
+def _close(a, b):
+    return abs(_as_float(a) - _as_float(b)) <= 1e-9 * max(1.0, abs(_as_float(a)), abs(_as_float(b)))
+
+def _solve_equation(left, right, var):
+    """Solve left = right for var when it is a polynomial of degree <= 2."""
+    def f(x):
+        return _evaluate(left, {var: x}) - _evaluate(right, {var: x})
+
+    half = Fraction(1, 2)  # keeps coefficients exact when f is rational
+    c = f(0)
+    f1, fm1 = f(1), f(-1)
+    a = (f1 + fm1) * half - c
+    b = (f1 - fm1) * half
+    for x in (2, 3):
+        if not _close(f(x), a * x * x + b * x + c):
+            raise MathError("not a linear or quadratic equation")
+    if _close(a, 0):
+        if _close(b, 0):
+            return "every value works! ♾️" if _close(c, 0) else "there is no solution 🙅"
+        return f"{var} = {format_number(-c / b)}"
+    disc = b * b - 4 * a * c
+    root = _sqrt(_simplify(disc))
+    roots = [(-b + root) / (2 * a), (-b - root) / (2 * a)]
+    if _close(roots[0], roots[1]):
+        return f"{var} = {format_number(roots[0])}"
+    return f"{var} = {format_number(roots[0])} or {var} = {format_number(roots[1])}"
+
+def _finite(value):
+    if isinstance(value, complex):
+        return cmath.isfinite(value)
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return True
+
+def solve_locally(problem):
+    """Answer a math problem without the LLM, or return None if it isn't simple enough."""
+    text = _prepare_expression(problem)
+    try:
+        if text.count("=") == 1:
+            left, right = (_parse_expression(side.strip()) for side in text.split("="))
+            names = {node.id for side in (left, right) for node in ast.walk(side) if isinstance(node, ast.Name)}
+            unknowns = names - set(_MATH_FUNCTIONS) - set(_MATH_CONSTANTS)
+            if len(unknowns) != 1:
+                return None
+            var = unknowns.pop()
+            return f"🧮 {problem.strip()}\n\n✨ {_solve_equation(left, right, var)} 💖"
+        value = _evaluate(_parse_expression(text), {})
+        if not _finite(value):
+            return None  # overflow or a pole; let the LLM explain
+        return f"🧮 {problem.strip()}\n\n✨ = {format_number(value)} 💖"
+    except (MathError, ArithmeticError, ValueError, TypeError):
+        return None
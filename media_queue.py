@@ -0,0 +1,147 @@
+"""Bounded, per-user fair queue for ffmpeg jobs, so text handlers never wait on encodes."""
+
+import time
+import threading
+from collections import deque
+
+class JobCancelled(Exception):
+    pass
+
+class JobTimeout(Exception):
+    pass
+
+class MediaQueueFull(Exception):
+    pass
+
+class MediaUserLimit(Exception):
+    pass
+
+class MediaDuplicate(Exception):
+    pass
+
+class MediaJob:
+    def __init__(self, user_id, chat_id, func, args, label, dedupe_key, priority):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.label = label
+        self.dedupe_key = dedupe_key
+        self.priority = priority  # lower runs first
+        self.queued_at = time.monotonic()
+        self.cancelled = threading.Event()
+        self.proc = None  # ffmpeg process while one runs, so cancel() can kill it
+        self.deadline = None  # set by run_job when the job starts
+
+    def cancel(self):
+        self.cancelled.set()
+        proc = self.proc
+        if proc and proc.poll() is None:
+            proc.kill()
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic()) if self.deadline else None
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise JobCancelled()
+        if self.deadline and time.monotonic() > self.deadline:
+            raise JobTimeout()
+
+class MediaJobQueue:
+    """Bounded priority queue of media jobs run by a fixed pool of worker threads.
+
+    Each user may have per_user_running jobs running and per_user_queued waiting;
+    run_job(job) does the actual work on a worker thread.
+    """
+
+    def __init__(self, workers, max_queued, per_user_running, per_user_queued, run_job):
+        self.workers = workers
+        self.run_job = run_job
+        self.max_queued = max_queued
+        self.per_user_running = per_user_running
+        self.per_user_queued = per_user_queued
+        self.cond = threading.Condition()
+        self.pending = deque()
+        self.running = {}  # user_id -> list of running jobs
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"media-worker-{i}", daemon=True).start()
+
+    def submit(self, user_id, chat_id, func, *args, label="media", dedupe_key=None, priority=1):
+        """Queue a job; returns its place in the queue, or 0 if a worker picks it up right away."""
+        with self.cond:
+            if dedupe_key is not None and self._active(user_id, dedupe_key):
+                raise MediaDuplicate()
+            queued = sum(1 for job in self.pending if job.user_id == user_id)
+            if queued >= self.per_user_queued:
+                raise MediaUserLimit()
+            if len(self.pending) >= self.max_queued:
+                raise MediaQueueFull()
+            ahead = [job for job in self.pending if job.priority <= priority]
+            # It starts now only if a worker is free after the runnable jobs ahead of it,
+            # and the user's own running jobs leave room
+            free = self.workers - sum(len(jobs) for jobs in self.running.values())
+            runnable_ahead = sum(1 for job in ahead if self._may_start(job.user_id))
+            waits = not self._may_start(user_id) or runnable_ahead >= free
+            self.pending.append(MediaJob(user_id, chat_id, func, args, label, dedupe_key, priority))
+            self.cond.notify()
+            return len(ahead) + 1 if waits else 0
+
+    def _may_start(self, user_id):
+        return len(self.running.get(user_id, [])) < self.per_user_running
+
+    def _active(self, user_id, dedupe_key):
+        jobs = list(self.running.get(user_id, [])) + [job for job in self.pending if job.user_id == user_id]
+        return any(job.dedupe_key == dedupe_key for job in jobs)
+
+    def is_active(self, user_id, dedupe_key):
+        """Whether the user already has this job queued or running."""
+        with self.cond:
+            return self._active(user_id, dedupe_key)
+
+    def drain(self, timeout):
+        """Wait until no jobs are queued or running; returns False on timeout."""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending and not self.running, timeout)
+
+    def cancel_user(self, user_id):
+        """Drop queued jobs and kill running ones for a user; returns how many were cancelled."""
+        with self.cond:
+            dropped = [job for job in self.pending if job.user_id == user_id]
+            for job in dropped:
+                self.pending.remove(job)
+            running = list(self.running.get(user_id, []))
+        for job in dropped + running:
+            job.cancel()
+        return len(dropped) + len(running)
+
+    def depth(self):
+        with self.cond:
+            return len(self.pending)
+
+    def _next_job(self):
+        best = None
+        for job in self.pending:
+            if self._may_start(job.user_id) and (best is None or job.priority < best.priority):
+                best = job
+        if best is not None:
+            self.pending.remove(best)
+        return best
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                job = self._next_job()
+                while job is None:
+                    self.cond.wait()
+                    job = self._next_job()
+                self.running.setdefault(job.user_id, []).append(job)
+            try:
+                self.run_job(job)
+            finally:
+                with self.cond:
+                    jobs = self.running[job.user_id]
+                    jobs.remove(job)
+                    if not jobs:
+                        del self.running[job.user_id]
+                    self.cond.notify_all()
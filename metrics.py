@@ -0,0 +1,106 @@
+"""Minimal Prometheus text-format metrics. Updates are plain unlocked
+increments: under the GIL a rare lost update under contention is an acceptable
+price for keeping locks and allocations off the hot path.
+"""
+
+import time
+import bisect
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}  # label values tuple -> count
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in list(self.values.items()):
+            lines.append(f"{self.name}{_label_str(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values tuple -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series.setdefault(label_values, [0] * (len(self.buckets) + 2))
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, series in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = _label_str(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _label_str(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class CallbackMetric:
+    """Value computed at scrape time; fn returns a number or {label value: number}."""
+
+    def __init__(self, name, help_text, fn, label=None, kind="gauge"):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.label = label
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"Metric {self.name} failed: {e}")
+            return lines
+        if isinstance(value, dict):
+            for label_value, v in value.items():
+                lines.append(f"{self.name}{_label_str((self.label,), (label_value,))} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+def _label_value(value):
+    # Exposition format escapes for label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_str(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_label_value(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def bounded_label(value, allowed):
+    """Label value from user input, kept to a fixed set so clients can't mint new series."""
+    return value if value in allowed else "other"
+
+class Timer:
+    """`with Timer(histogram, *labels):` observes the block's wall time."""
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, *labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
@@ -0,0 +1,299 @@
+"""Bot API sends, scheduled per chat.
+
+Every Bot API call that posts into a chat waits for its turn here. Each chat
+has a lane: sends to one chat go out in order, one at a time, within the
+chat's rate; lanes take turns by priority (interactive replies before media)
+within the global rate. A 429 pauses the lane for the retry_after Telegram
+asks for and the send is retried. Plain texts waiting in the same lane are
+merged into one message. A blocking send never holds its thread longer than
+max_wait: past that it fails with OutboundTimeout.
+"""
+
+import json
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from metrics import Counter
+
+TELEGRAM_MAX_MESSAGE = 4096
+
+OUTBOUND_PRIORITIES = {
+    "sendMessage": 0, "editMessageText": 0,
+    "sendPhoto": 1, "sendMediaGroup": 1, "sendAudio": 1, "sendVoice": 1,
+    "sendVideo": 1, "sendAnimation": 1, "sendDocument": 1,
+}
+_MERGEABLE_PARAMS = {"chat_id", "text", "reply_markup"}
+_unmergeable = contextvars.ContextVar("unmergeable", default=False)
+
+class OutboundTimeout(TimeoutError):
+    """A send didn't get its turn within the dispatcher's max_wait."""
+
+class _Send:
+    __slots__ = ("chat_id", "params", "priority", "cost", "seq", "mergeable", "turn", "done")
+
+    def __init__(self, chat_id, method, params, seq):
+        self.chat_id = chat_id
+        self.params = params
+        self.priority = OUTBOUND_PRIORITIES[method]
+        self.cost = 1
+        if method == "sendMediaGroup":
+            try:
+                self.cost = max(1, len(json.loads(params.get("media") or "[]")))  # albums count per photo
+            except (TypeError, ValueError):
+                pass
+        self.seq = seq
+        # Inline keyboards get edited later (effect pickers, choices), which would wipe merged text
+        self.mergeable = (method == "sendMessage" and set(params) <= _MERGEABLE_PARAMS
+                          and isinstance(params.get("text"), str) and "inline_keyboard" not in str(params.get("reply_markup", ""))
+                          and not _unmergeable.get())
+        self.turn = Future()  # result: None to send now, or the _Send this one was merged into
+        self.done = Future()  # result of the actual request, shared with merged sends
+
+class _Lane:
+    __slots__ = ("queue", "rate", "burst", "tokens", "refilled", "blocked_until", "busy")
+
+    def __init__(self, rate, burst, now):
+        self.queue = deque()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.refilled = now
+        self.blocked_until = 0.0
+        self.busy = False
+
+    def ready_at(self, cost, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        cost = min(cost, self.burst)
+        return max(self.blocked_until, now + max(0.0, cost - self.tokens) / self.rate)
+
+    def spend(self, cost):
+        self.tokens -= min(cost, self.burst)
+
+class OutboundDispatcher:
+    def __init__(self, session, chat_rate, chat_burst, group_rate, global_rate, max_retries, max_retry_wait, max_wait,
+                 max_text=TELEGRAM_MAX_MESSAGE):
+        self.session = session  # requests.Session-like; sends go through its request()
+        self.max_text = max_text
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_retry_wait = max_retry_wait
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        self.lanes = {}  # chat_id -> _Lane
+        self.overall = _Lane(global_rate, global_rate, time.monotonic())
+        self.seq = 0
+        self.waiting = 0
+        threading.Thread(target=self._schedule, name="outbound", daemon=True).start()
+
+    @staticmethod
+    def _target(url, params):
+        """(API method, chat id) of a call that should be scheduled, else None."""
+        method = url.rsplit("/", 1)[-1]
+        chat_id = params.get("chat_id") if isinstance(params, dict) else None
+        if method not in OUTBOUND_PRIORITIES or chat_id is None:
+            return None
+        return method, chat_id
+
+    def _enqueue(self, method, chat_id, params, front=None, deadline=None):
+        with self.cond:
+            now = time.monotonic()
+            lane = self.lanes.get(chat_id)
+            if lane is None:
+                # Group and channel ids are negative; those chats get the slower limit
+                rate = self.group_rate if str(chat_id).startswith(("-", "@")) else self.chat_rate
+                lane = self.lanes[chat_id] = _Lane(rate, self.chat_burst, now)
+            if deadline is not None and lane.blocked_until > deadline:
+                # Paused by a 429 for longer than the caller may wait: fail now rather than later
+                raise OutboundTimeout(f"chat {chat_id} is paused by Telegram for {lane.blocked_until - now:.0f}s")
+            if front is not None:
+                # A retried send keeps its place at the head of the lane
+                front.turn = Future()
+                lane.queue.appendleft(front)
+                send = front
+            else:
+                self.seq += 1
+                send = _Send(chat_id, method, params, self.seq)
+                lane.queue.append(send)
+            self.waiting += 1
+            self.cond.notify()
+            return send
+
+    def _await_turn(self, send, deadline):
+        """Leader send was merged into (None to send now); withdraws it at the deadline."""
+        try:
+            return send.turn.result(max(0.0, deadline - time.monotonic()))
+        except FutureTimeout:
+            with self.cond:
+                if not send.turn.done():
+                    self.lanes[send.chat_id].queue.remove(send)
+                    self.waiting -= 1
+                    raise OutboundTimeout(f"send to chat {send.chat_id} waited over {self.max_wait:g}s") from None
+            return send.turn.result()  # granted while we were giving up
+
+    def _finished(self, send, retry_after=None):
+        with self.cond:
+            lane = self.lanes[send.chat_id]
+            lane.busy = False
+            if retry_after:
+                lane.blocked_until = time.monotonic() + retry_after
+            self.cond.notify()
+
+    def _grant(self, lane, now):
+        send = lane.queue.popleft()
+        group = [send]
+        if send.mergeable:
+            text = send.params["text"]
+            # Only the last message of a merged group may carry a keyboard
+            while lane.queue and lane.queue[0].mergeable and "reply_markup" not in group[-1].params:
+                merged = text + "\n\n" + lane.queue[0].params["text"]
+                if len(merged) > self.max_text:
+                    break
+                text = merged
+                group.append(lane.queue.popleft())
+            if len(group) > 1:
+                send.params = dict(send.params, text=text)
+                if "reply_markup" in group[-1].params:
+                    send.params["reply_markup"] = group[-1].params["reply_markup"]
+                OUTBOUND_MERGED.inc(amount=len(group) - 1)
+        lane.spend(send.cost)
+        self.overall.spend(send.cost)
+        lane.busy = True
+        self.waiting -= len(group)
+        send.turn.set_result(None)
+        for follower in group[1:]:
+            follower.turn.set_result(send)
+
+    def _schedule(self):
+        last_prune = time.monotonic()
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                wake = None
+                heads = sorted((lane.queue[0].priority, lane.queue[0].seq, chat_id)
+                               for chat_id, lane in self.lanes.items() if lane.queue and not lane.busy)
+                for _, _, chat_id in heads:
+                    lane = self.lanes[chat_id]
+                    cost = lane.queue[0].cost
+                    overall_at = self.overall.ready_at(cost, now)
+                    if overall_at > now:
+                        # Out of global budget: nothing lower in priority may jump ahead
+                        wake = overall_at if wake is None else min(wake, overall_at)
+                        break
+                    lane_at = lane.ready_at(cost, now)
+                    if lane_at > now:
+                        wake = lane_at if wake is None else min(wake, lane_at)
+                        continue
+                    self._grant(lane, now)
+                if now - last_prune > 60:
+                    last_prune = now
+                    for chat_id in [c for c, lane in self.lanes.items()
+                                    if not lane.queue and not lane.busy and lane.ready_at(lane.burst, now) <= now]:
+                        del self.lanes[chat_id]
+                self.cond.wait(None if wake is None else max(0.001, wake - now))
+
+    @staticmethod
+    def _rewind(files):
+        for value in (files or {}).values():
+            f = value[1] if isinstance(value, tuple) else value
+            if hasattr(f, "seek"):
+                f.seek(0)
+
+    def request(self, method, url, **kwargs):
+        """Drop-in for requests' request(); used as telebot's request sender."""
+        target = self._target(url, kwargs.get("params"))
+        if target is None:
+            return self.session.request(method, url, **kwargs)
+        # The calling thread serves other updates too, so its waiting is bounded
+        deadline = time.monotonic() + self.max_wait
+        send = self._enqueue(*target, kwargs.get("params"), deadline=deadline)
+        leader = self._await_turn(send, deadline)
+        if leader is not None:
+            try:
+                return leader.done.result(max(0.0, deadline - time.monotonic()))
+            except FutureTimeout:
+                raise OutboundTimeout(f"merged send to chat {send.chat_id} waited over {self.max_wait:g}s") from None
+        try:
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                try:
+                    response = self.session.request(method, url, **dict(kwargs, params=send.params))
+                    if response.status_code == 429:
+                        retry_after = _telegram_retry_after(response.json())
+                finally:
+                    self._finished(send, retry_after)
+                if (retry_after is None or attempt == self.max_retries
+                        or retry_after > min(self.max_retry_wait, deadline - time.monotonic())):
+                    break  # a 429 that is given up on reaches telebot as an ApiTelegramException
+                OUTBOUND_THROTTLED.inc()
+                self._rewind(kwargs.get("files"))
+                self._enqueue(None, send.chat_id, None, front=send)
+                try:
+                    self._await_turn(send, deadline)
+                except OutboundTimeout:
+                    break
+        except BaseException as e:
+            send.done.set_exception(e)
+            raise
+        send.done.set_result(response)
+        return response
+
+    def wrap_async(self, process_request):
+        """Same scheduling for the async bot's request function."""
+        from telebot.asyncio_helper import ApiTelegramException
+
+        async def scheduled(token, url, method="get", params=None, files=None, **kwargs):
+            target = self._target(url, params)
+            if target is None:
+                return await process_request(token, url, method, params, files, **kwargs)
+            send = self._enqueue(*target, params)
+            leader = await asyncio.wrap_future(send.turn)
+            if leader is not None:
+                return await asyncio.wrap_future(leader.done)
+            try:
+                for attempt in range(self.max_retries + 1):
+                    retry_after = None
+                    try:
+                        result = await process_request(token, url, method, send.params, files, **kwargs)
+                    except ApiTelegramException as e:
+                        retry_after = _telegram_retry_after(e.result_json) if e.error_code == 429 else None
+                        if retry_after is None or attempt == self.max_retries or retry_after > self.max_retry_wait:
+                            raise
+                    else:
+                        break
+                    finally:
+                        self._finished(send, retry_after)
+                    OUTBOUND_THROTTLED.inc()
+                    self._rewind(files)
+                    await asyncio.wrap_future(self._enqueue(None, send.chat_id, None, front=send).turn)
+            except BaseException as e:
+                send.done.set_exception(e)
+                raise
+            send.done.set_result(result)
+            return result
+
+        return scheduled
+
+class unmerged:
+    """`with unmerged():` sends in the block are never merged with other texts (e.g. messages that get edited later)."""
+
+    def __enter__(self):
+        self.token = _unmergeable.set(True)
+
+    def __exit__(self, *exc):
+        _unmergeable.reset(self.token)
+
+def _telegram_retry_after(result):
+    try:
+        return float(result["parameters"]["retry_after"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+OUTBOUND_MERGED = Counter("bot_outbound_merged_total", "Text messages merged into an earlier send to the same chat.")
+OUTBOUND_THROTTLED = Counter("bot_outbound_throttled_total", "Sends retried after a 429 from Telegram.")
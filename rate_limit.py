@@ -0,0 +1,41 @@
+"""Token-bucket admission control: a bucket per user plus one shared by everyone."""
+
+import time
+import threading
+from collections import OrderedDict
+
+class RateLimiter:
+    def __init__(self, user_rate, user_burst, global_rate, global_burst, max_users=50000):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.max_users = max_users
+        self.users = OrderedDict()  # user_id -> [tokens, last_refill]
+        self.global_bucket = [global_burst, time.monotonic()]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _refill(bucket, rate, burst, now):
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+    def admit(self, user_id, cost):
+        """Take cost tokens from both buckets; returns 0 if admitted, else seconds to wait."""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.users.get(user_id)
+            if bucket is None:
+                bucket = self.users[user_id] = [self.user_burst, now]
+                if len(self.users) > self.max_users:
+                    self.users.popitem(last=False)  # least recently seen user starts over with a full bucket
+            self.users.move_to_end(user_id)
+            self._refill(bucket, self.user_rate, self.user_burst, now)
+            self._refill(self.global_bucket, self.global_rate, self.global_burst, now)
+            if bucket[0] < cost:
+                return (cost - bucket[0]) / self.user_rate
+            if self.global_bucket[0] < cost:
+                return (cost - self.global_bucket[0]) / self.global_rate
+            bucket[0] -= cost
+            self.global_bucket[0] -= cost
+            return 0
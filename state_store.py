@@ -0,0 +1,209 @@
+"""Per-user session state: a bounded in-memory LRU, optionally written behind to SQLite."""
+
+import json
+import time
+import atexit
+import sqlite3
+import threading
+from collections import OrderedDict
+
+def default_state():
+    return {"mode": "normal", "dream_history": []}
+
+def _copy_state(state):
+    return {k: v.copy() if isinstance(v, (list, dict)) else v for k, v in state.items()}
+
+class MemoryStateStore:
+    """Bounded in-memory LRU of user sessions with idle expiry (lost on restart)."""
+
+    def __init__(self, max_sessions, idle_ttl):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.sessions = OrderedDict()  # user_id -> [last_seen, state]
+        self.lock = threading.RLock()
+
+    # Hooks for persistent backends
+    def _load(self, user_id):
+        return None
+
+    def _changed(self, user_id):
+        pass
+
+    def _evicted(self, user_id, state):
+        pass
+
+    def flush(self):
+        pass
+
+    def _touch(self, user_id, create):
+        entry = self.sessions.get(user_id)
+        if entry is None:
+            state = self._load(user_id)
+            if state is None:
+                if not create:
+                    return None
+                state = default_state()
+            entry = self.sessions[user_id] = [0.0, state]
+            self._trim()
+        entry[0] = time.monotonic()
+        self.sessions.move_to_end(user_id)
+        return entry[1]
+
+    def _trim(self):
+        while len(self.sessions) > self.max_sessions:
+            user_id, (_, state) = self.sessions.popitem(last=False)
+            self._evicted(user_id, state)
+
+    def get(self, user_id):
+        with self.lock:
+            state = self._touch(user_id, create=False)
+            return _copy_state(state) if state is not None else default_state()
+
+    def update(self, user_id, **kwargs):
+        with self.lock:
+            self._touch(user_id, create=True).update(kwargs)
+            self._changed(user_id)
+
+    def reset(self, user_id, **kwargs):
+        with self.lock:
+            state = default_state()
+            state.update(kwargs)
+            self.sessions[user_id] = [time.monotonic(), state]
+            self.sessions.move_to_end(user_id)
+            self._trim()
+            self._changed(user_id)
+
+    def modify(self, user_id, fn):
+        """Apply fn(state) to the live state under the store lock."""
+        with self.lock:
+            fn(self._touch(user_id, create=True))
+            self._changed(user_id)
+
+    def append(self, user_id, key, *items, limit=None):
+        with self.lock:
+            state = self._touch(user_id, create=True)
+            values = state.get(key, []) + list(items)
+            state[key] = values[-limit:] if limit else values
+            self._changed(user_id)
+
+    def sweep(self):
+        """Drop sessions that have been idle longer than idle_ttl."""
+        cutoff = time.monotonic() - self.idle_ttl
+        with self.lock:
+            # Oldest first, so stop at the first recently used session
+            while self.sessions:
+                user_id, (last_seen, state) = next(iter(self.sessions.items()))
+                if last_seen >= cutoff:
+                    break
+                del self.sessions[user_id]
+                self._evicted(user_id, state)
+
+    def __len__(self):
+        return len(self.sessions)
+
+class SQLiteStateStore(MemoryStateStore):
+    """Sessions persisted in SQLite (WAL) behind the in-memory LRU.
+
+    Changes are written behind in batches every flush_interval seconds. The
+    store lock is only held to snapshot the dirty sessions; serializing and
+    writing happen outside it, so handlers never wait on disk (or on another
+    shard's write lock). Sessions idle for longer than session_ttl are deleted
+    from disk.
+    """
+
+    def __init__(self, path, max_sessions, idle_ttl, session_ttl, flush_interval):
+        super().__init__(max_sessions, idle_ttl)
+        self.session_ttl = session_ttl
+        self.flush_interval = flush_interval
+        self.dirty = set()
+        self.spilled = {}  # dirty sessions evicted from memory before their flush
+        self.writing = {}  # snapshots of the flush in progress, until they are committed
+        self.write_lock = threading.Lock()  # one flush/expire on the writer connection at a time
+        # Shard processes share the file; wait out each other's write locks
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS user_state (user_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS user_state_updated_at ON user_state (updated_at)")
+        self.db.commit()
+        # Loads run under the store lock; with WAL they never wait for a writer
+        self.reader = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        threading.Thread(target=self._maintain, name="state-flusher", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _load(self, user_id):
+        if user_id in self.spilled:
+            return self.spilled.pop(user_id)
+        if user_id in self.writing:
+            return _copy_state(self.writing[user_id])
+        row = self.reader.execute("SELECT state FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _changed(self, user_id):
+        self.dirty.add(user_id)
+
+    def _evicted(self, user_id, state):
+        if user_id in self.dirty:
+            self.spilled[user_id] = state
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                for user_id in self.dirty:
+                    entry = self.sessions.get(user_id)
+                    state = entry[1] if entry else self.spilled.get(user_id)
+                    if state is not None:
+                        self.writing[user_id] = _copy_state(state)
+                self.dirty = set()
+                self.spilled = {}
+                snapshot = self.writing
+            now = time.time()
+            try:
+                rows = [(user_id, json.dumps(state), now) for user_id, state in snapshot.items()]
+                with self.db:
+                    self.db.executemany(
+                        "INSERT INTO user_state (user_id, state, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                        rows)
+            except Exception:
+                # Keep them dirty for the next flush; newer changes made meanwhile win
+                with self.lock:
+                    for user_id, state in snapshot.items():
+                        self.dirty.add(user_id)
+                        if user_id not in self.sessions:
+                            self.spilled.setdefault(user_id, state)
+                raise
+            finally:
+                with self.lock:
+                    self.writing = {}
+
+    def expire(self):
+        with self.write_lock, self.db:
+            self.db.execute("DELETE FROM user_state WHERE updated_at < ?", (time.time() - self.session_ttl,))
+
+    def _maintain(self):
+        last_sweep = time.monotonic()
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.monotonic() - last_sweep > 60:
+                    last_sweep = time.monotonic()
+                    self.sweep()
+                    self.expire()
+            except Exception as e:
+                print(f"State store error: {e}")
+
+class SweepingMemoryStateStore(MemoryStateStore):
+    """MemoryStateStore that drops idle sessions once a minute on its own thread."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        threading.Thread(target=self._maintain, name="state-sweeper", daemon=True).start()
+
+    def _maintain(self):
+        while True:
+            time.sleep(60)
+            self.sweep()
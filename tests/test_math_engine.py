@@ -0,0 +1,72 @@
+import pytest
+
+from math_engine import solve_locally, math_cache_key
+
+
+def answer(problem):
+    result = solve_locally(problem)
+    assert result is not None, problem
+    return result.split("✨ ", 1)[1].rsplit(" 💖", 1)[0]
+
+
+@pytest.mark.parametrize("problem, expected", [
+    ("2+2", "= 4"),
+    ("what is 2 + 2?", "= 4"),
+    ("1/3 + 1/6", "= 1/2 ≈ 0.5"),
+    ("2^10", "= 1024"),
+    ("3(4+1)", "= 15"),
+    ("sqrt(16)", "= 4"),
+    ("sqrt(-4)", "= 2i"),
+    ("(1+2i)*(1-2i)", "= 5"),
+    ("sin(180°)", "= 0"),
+    ("cos(60°)", "= 0.5"),
+    ("tan(45°)", "= 1"),
+    ("factorial(5)", "= 120"),
+    ("log(-1)", "= 3.14159265359i"),
+])
+def test_evaluates(problem, expected):
+    assert answer(problem) == expected
+
+
+@pytest.mark.parametrize("problem, expected", [
+    ("2x + 3 = 7", "x = 2"),
+    ("x^2 - 5x + 6 = 0", "x = 3 or x = 2"),
+    ("x^2 = -1", "x = i or x = -i"),
+    ("x^2 - 2x + 1 = 0", "x = 1"),
+    ("x + 1 = x + 1", "every value works! ♾️"),
+    ("x + 1 = x + 2", "there is no solution 🙅"),
+])
+def test_solves_equations(problem, expected):
+    assert answer(problem) == expected
+
+
+@pytest.mark.parametrize("problem", [
+    "tan(90°)",
+    "tan(pi/2)",
+    "1/cos(pi/2)",
+    "1/0",
+    "exp(1000)",
+    "10.0^400",
+    "2^100000",
+    "factorial(1000)",
+])
+def test_poles_and_overflow_are_unsolved(problem):
+    assert solve_locally(problem) is None
+
+
+@pytest.mark.parametrize("problem", [
+    "x^3 = 8",
+    "x + y = 3",
+    "write me a poem",
+    "__import__('os')",
+    "(1).__class__",
+    "2" * 300,
+])
+def test_leaves_the_rest_to_the_llm(problem):
+    assert solve_locally(problem) is None
+
+
+def test_cache_key_ignores_phrasing_and_spacing():
+    assert math_cache_key("2+2") == math_cache_key("2 + 2") == math_cache_key("What is 2+2?")
+    assert math_cache_key("2x + 1") == math_cache_key("2*x+1")
+    assert math_cache_key("2+2") != math_cache_key("2+3")
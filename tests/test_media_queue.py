@@ -0,0 +1,115 @@
+import threading
+
+import pytest
+
+from media_queue import JobCancelled, MediaDuplicate, MediaJobQueue, MediaQueueFull, MediaUserLimit
+
+
+class Recorder:
+    """Jobs block until released, and record the order they started in."""
+
+    def __init__(self):
+        self.started = []
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+
+    def job(self, job, name):
+        with self.lock:
+            self.started.append(name)
+        while not self.release.wait(0.01):
+            job.check()
+
+    def wait_started(self, count):
+        for _ in range(500):
+            with self.lock:
+                if len(self.started) >= count:
+                    return
+            self.release.wait(0.01)
+        raise AssertionError(f"only {self.started} started")
+
+
+def run_job(job):
+    try:
+        job.func(job, *job.args)
+    except JobCancelled:
+        pass
+
+
+def make_queue(workers=1, max_queued=10, per_user_running=1, per_user_queued=5):
+    return MediaJobQueue(workers, max_queued, per_user_running, per_user_queued, run_job)
+
+
+def test_positions_count_jobs_that_have_to_wait():
+    jobs, rec = make_queue(), Recorder()
+    assert jobs.submit("a", 1, rec.job, "a1") == 0
+    rec.wait_started(1)
+    assert jobs.submit("b", 2, rec.job, "b1") == 1
+    assert jobs.submit("c", 3, rec.job, "c1") == 2
+    rec.release.set()
+    assert jobs.drain(5)
+    assert rec.started == ["a1", "b1", "c1"]
+
+
+def test_previews_run_before_full_renders():
+    jobs, rec = make_queue(), Recorder()
+    jobs.submit("a", 1, rec.job, "busy")
+    rec.wait_started(1)
+    jobs.submit("b", 2, rec.job, "full", priority=1)
+    assert jobs.submit("c", 3, rec.job, "preview", priority=0) == 1
+    rec.release.set()
+    assert jobs.drain(5)
+    assert rec.started == ["busy", "preview", "full"]
+
+
+def test_users_over_their_running_cap_wait_without_blocking_others():
+    jobs, rec = make_queue(workers=2), Recorder()
+    jobs.submit("a", 1, rec.job, "a1")
+    rec.wait_started(1)
+    assert jobs.submit("a", 1, rec.job, "a2") == 1  # a worker is free, but "a" is at its cap
+    assert jobs.submit("b", 2, rec.job, "b1") == 0
+    rec.wait_started(2)
+    assert rec.started == ["a1", "b1"]
+    rec.release.set()
+    assert jobs.drain(5)
+    assert rec.started[-1] == "a2"
+
+
+def test_limits():
+    jobs, rec = make_queue(max_queued=3, per_user_queued=2), Recorder()
+    jobs.submit("a", 1, rec.job, "running")
+    rec.wait_started(1)
+    jobs.submit("a", 1, rec.job, "a2", dedupe_key="k")
+    with pytest.raises(MediaDuplicate):
+        jobs.submit("a", 1, rec.job, "again", dedupe_key="k")
+    assert jobs.is_active("a", "k")
+    jobs.submit("a", 1, rec.job, "a3")
+    with pytest.raises(MediaUserLimit):
+        jobs.submit("a", 1, rec.job, "a4")
+    jobs.submit("b", 2, rec.job, "b1")
+    with pytest.raises(MediaQueueFull):
+        jobs.submit("c", 3, rec.job, "c1")
+    assert jobs.depth() == 3
+    rec.release.set()
+    assert jobs.drain(5)
+    assert not jobs.is_active("a", "k")
+
+
+def test_cancel_user_drops_queued_and_stops_running_jobs():
+    jobs, rec = make_queue(), Recorder()
+    jobs.submit("a", 1, rec.job, "a1")
+    rec.wait_started(1)
+    jobs.submit("a", 1, rec.job, "a2")
+    jobs.submit("b", 2, rec.job, "b1")
+    assert jobs.cancel_user("a") == 2
+    rec.wait_started(2)  # the running job stopped, so "b" gets the worker
+    rec.release.set()
+    assert jobs.drain(5)
+    assert rec.started == ["a1", "b1"]
+
+
+def test_drain_times_out_while_jobs_run():
+    jobs, rec = make_queue(), Recorder()
+    jobs.submit("a", 1, rec.job, "a1")
+    assert not jobs.drain(0.05)
+    rec.release.set()
+    assert jobs.drain(5)
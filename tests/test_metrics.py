@@ -0,0 +1,55 @@
+from metrics import CallbackMetric, Counter, Histogram, Timer, bounded_label
+
+
+def test_counter_renders_each_series():
+    counter = Counter("shed_total", "Updates turned away.", ("action", "reason"))
+    counter.inc("llm", "rate_limit")
+    counter.inc("llm", "rate_limit", amount=2)
+    counter.inc("media", "media_queue_full")
+    assert counter.render() == [
+        "# HELP shed_total Updates turned away.",
+        "# TYPE shed_total counter",
+        'shed_total{action="llm",reason="rate_limit"} 3',
+        'shed_total{action="media",reason="media_queue_full"} 1',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("seconds", "Latency.", ("service",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, "unsplash")
+    assert histogram.render()[2:] == [
+        'seconds_bucket{service="unsplash",le="0.1"} 1',
+        'seconds_bucket{service="unsplash",le="1"} 2',
+        'seconds_bucket{service="unsplash",le="+Inf"} 3',
+        'seconds_sum{service="unsplash"} 5.55',
+        'seconds_count{service="unsplash"} 3',
+    ]
+
+
+def test_label_values_are_escaped():
+    counter = Counter("handler_total", "Handled.", ("handler",))
+    counter.inc('x"}\nevil 1\\')
+    line = counter.render()[-1]
+    assert line == 'handler_total{handler="x\\"}\\nevil 1\\\\"} 1'
+    assert "\n" not in line
+
+
+def test_user_supplied_labels_are_bounded():
+    assert bounded_label("slow", ("slow", "bass")) == "slow"
+    assert bounded_label("forged", ("slow", "bass")) == "other"
+
+
+def test_callback_metric_failures_keep_the_header():
+    def broken():
+        raise RuntimeError("gone")
+
+    assert CallbackMetric("depth", "Queue depth.", broken).render() == ["# HELP depth Queue depth.", "# TYPE depth gauge"]
+    assert CallbackMetric("cache", "Lookups.", lambda: {"hit": 2}, label="result").render()[-1] == 'cache{result="hit"} 2'
+
+
+def test_timer_observes_the_block():
+    histogram = Histogram("seconds", "Latency.", ("handler",))
+    with Timer(histogram, "text"):
+        pass
+    assert histogram.render()[-1] == 'seconds_count{handler="text"} 1'
@@ -0,0 +1,178 @@
+import json
+import threading
+import time
+
+import pytest
+
+from outbound import OutboundDispatcher, OutboundTimeout, unmerged
+
+API = "https://api.telegram.org/botTOKEN/"
+INLINE = json.dumps({"inline_keyboard": [[{"text": "Slow", "callback_data": "effect_slow"}]]})
+REPLY = json.dumps({"keyboard": [["🔙 Back"]], "resize_keyboard": True})
+
+
+class Response:
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.body = body or {"ok": True, "result": {}}
+
+    def json(self):
+        return self.body
+
+
+class Session:
+    """Records sends; answers with queued responses, then 200s."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.sent.append((time.monotonic(), url.rsplit("/", 1)[-1], kwargs.get("params")))
+            return self.responses.pop(0) if self.responses else Response()
+
+    def texts(self):
+        return [params["text"] for _, _, params in self.sent]
+
+
+def dispatcher(session, chat_rate=100.0, chat_burst=100, global_rate=1000.0, max_wait=5.0):
+    return OutboundDispatcher(session, chat_rate, chat_burst, group_rate=1.0, global_rate=global_rate,
+                              max_retries=3, max_retry_wait=60, max_wait=max_wait)
+
+
+def send_all(outbound, calls, spacing=0.02):
+    """Issue calls from separate threads, in order, as concurrent handlers would."""
+    results = [None] * len(calls)
+
+    def send(i, method, params):
+        try:
+            results[i] = outbound.request("post", API + method, params=params)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=send, args=(i, *call)) for i, call in enumerate(calls)]
+    for t in threads:
+        t.start()
+        time.sleep(spacing)
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_queued_texts_to_one_chat_are_merged():
+    session = Session()
+    outbound = dispatcher(session, chat_rate=5, chat_burst=1)
+    results = send_all(outbound, [("sendMessage", {"chat_id": 1, "text": t}) for t in ("a", "b", "c")])
+    assert session.texts() == ["a", "b\n\nc"]
+    assert results[1] is results[2]
+    assert outbound.waiting == 0
+
+
+def test_inline_keyboards_are_never_merged():
+    session = Session()
+    outbound = dispatcher(session, chat_rate=5, chat_burst=1)
+    send_all(outbound, [
+        ("sendMessage", {"chat_id": 1, "text": "first"}),
+        ("sendMessage", {"chat_id": 1, "text": "queued"}),
+        ("sendMessage", {"chat_id": 1, "text": "Choose an effect", "reply_markup": INLINE}),
+        ("sendMessage", {"chat_id": 1, "text": "later"}),
+    ])
+    # The picker is edited in place later, which would wipe any text merged into it
+    assert session.texts() == ["first", "queued", "Choose an effect", "later"]
+
+
+def test_reply_keyboard_moves_to_the_merged_message():
+    session = Session()
+    outbound = dispatcher(session, chat_rate=5, chat_burst=1)
+    send_all(outbound, [
+        ("sendMessage", {"chat_id": 1, "text": "first"}),
+        ("sendMessage", {"chat_id": 1, "text": "answer"}),
+        ("sendMessage", {"chat_id": 1, "text": "menu", "reply_markup": REPLY}),
+    ])
+    assert session.texts() == ["first", "answer\n\nmenu"]
+    assert session.sent[-1][2]["reply_markup"] == REPLY
+
+
+def test_unmerged_sends_stand_alone():
+    session = Session()
+    outbound = dispatcher(session, chat_rate=5, chat_burst=1)
+
+    def streamed(params):
+        with unmerged():
+            return outbound.request("post", API + "sendMessage", params=params)
+
+    first = threading.Thread(target=outbound.request, args=("post", API + "sendMessage"), kwargs={"params": {"chat_id": 1, "text": "a"}})
+    first.start()
+    time.sleep(0.02)
+    second = threading.Thread(target=streamed, args=({"chat_id": 1, "text": "edited later"},))
+    second.start()
+    time.sleep(0.02)
+    outbound.request("post", API + "sendMessage", params={"chat_id": 1, "text": "c"})
+    first.join()
+    second.join()
+    assert session.texts() == ["a", "edited later", "c"]
+
+
+def test_chat_rate_spaces_out_sends():
+    session = Session()
+    outbound = dispatcher(session, chat_rate=10, chat_burst=1)
+    send_all(outbound, [("sendPhoto", {"chat_id": 1, "photo": str(i)}) for i in range(3)], spacing=0)
+    times = [at for at, _, _ in session.sent]
+    assert [params["photo"] for _, _, params in session.sent] == ["0", "1", "2"]
+    assert times[2] - times[0] >= 0.18
+
+
+def test_replies_go_before_media_when_the_global_budget_is_short():
+    session = Session()
+    outbound = dispatcher(session, global_rate=5)
+    outbound.overall.tokens = 0  # spend the burst
+    send_all(outbound, [
+        ("sendAudio", {"chat_id": 1, "audio": "x"}),
+        ("sendMessage", {"chat_id": 2, "text": "hi"}),
+    ], spacing=0.01)
+    assert [method for _, method, _ in session.sent] == ["sendMessage", "sendAudio"]
+
+
+def test_429_pauses_the_chat_and_retries():
+    session = Session(Response(429, {"ok": False, "error_code": 429, "parameters": {"retry_after": 0.2}}))
+    outbound = dispatcher(session)
+    started = time.monotonic()
+    response = outbound.request("post", API + "sendMessage", params={"chat_id": 1, "text": "hi"})
+    assert response.status_code == 200
+    assert len(session.sent) == 2
+    assert time.monotonic() - started >= 0.2
+
+
+def test_429_longer_than_the_wait_bound_is_returned():
+    throttled = Response(429, {"ok": False, "error_code": 429, "parameters": {"retry_after": 30}})
+    session = Session(throttled)
+    outbound = dispatcher(session, max_wait=0.5)
+    assert outbound.request("post", API + "sendMessage", params={"chat_id": 1, "text": "hi"}) is throttled
+    # The chat stays paused, so further sends fail at once instead of holding the thread
+    started = time.monotonic()
+    with pytest.raises(OutboundTimeout):
+        outbound.request("post", API + "sendMessage", params={"chat_id": 1, "text": "again"})
+    assert time.monotonic() - started < 0.1
+    assert len(session.sent) == 1
+
+
+def test_sends_that_wait_too_long_give_up_their_place():
+    session = Session()
+    outbound = dispatcher(session, chat_rate=1, chat_burst=1, max_wait=0.3)
+    results = send_all(outbound, [("sendPhoto", {"chat_id": 1, "photo": str(i)}) for i in range(3)], spacing=0)
+    assert isinstance(results[1], OutboundTimeout) and isinstance(results[2], OutboundTimeout)
+    assert len(session.sent) == 1
+    assert outbound.waiting == 0
+    assert not outbound.lanes[1].queue
+
+
+def test_calls_without_a_chat_go_straight_through():
+    session = Session()
+    outbound = dispatcher(session, chat_rate=0.001, chat_burst=1)
+    outbound.lanes.clear()
+    for _ in range(3):
+        outbound.request("get", API + "getUpdates", params={"offset": 0})
+    assert len(session.sent) == 3
+    assert not outbound.lanes
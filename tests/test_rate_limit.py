@@ -0,0 +1,59 @@
+import pytest
+
+import rate_limit
+from rate_limit import RateLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_burst_then_wait_for_refill(clock):
+    limiter = RateLimiter(user_rate=1, user_burst=3, global_rate=100, global_burst=100)
+    assert [limiter.admit("u", 1) for _ in range(3)] == [0, 0, 0]
+    assert limiter.admit("u", 1) == pytest.approx(1.0)
+    clock[0] += 1
+    assert limiter.admit("u", 1) == 0
+
+
+def test_wait_covers_the_cost(clock):
+    limiter = RateLimiter(user_rate=2, user_burst=10, global_rate=100, global_burst=100)
+    assert limiter.admit("u", 10) == 0
+    assert limiter.admit("u", 5) == pytest.approx(2.5)
+
+
+def test_refused_updates_cost_nothing(clock):
+    limiter = RateLimiter(user_rate=1, user_burst=5, global_rate=100, global_burst=100)
+    assert limiter.admit("u", 5) == 0
+    clock[0] += 2
+    assert limiter.admit("u", 5) > 0
+    clock[0] += 3
+    assert limiter.admit("u", 5) == 0
+
+
+def test_users_have_separate_buckets(clock):
+    limiter = RateLimiter(user_rate=1, user_burst=2, global_rate=100, global_burst=100)
+    assert limiter.admit("a", 2) == 0
+    assert limiter.admit("a", 1) > 0
+    assert limiter.admit("b", 2) == 0
+
+
+def test_global_bucket_is_shared(clock):
+    limiter = RateLimiter(user_rate=1, user_burst=10, global_rate=5, global_burst=10)
+    assert limiter.admit("a", 6) == 0
+    assert limiter.admit("b", 6) == pytest.approx(0.4)
+    # A refused user keeps their own tokens
+    clock[0] += 0.5
+    assert limiter.admit("b", 6) == 0
+
+
+def test_forgotten_users_start_with_a_full_bucket(clock):
+    limiter = RateLimiter(user_rate=1, user_burst=2, global_rate=100, global_burst=100, max_users=2)
+    assert limiter.admit("a", 2) == 0
+    limiter.admit("b", 1)
+    limiter.admit("c", 1)
+    assert "a" not in limiter.users
+    assert limiter.admit("a", 2) == 0
@@ -0,0 +1,152 @@
+import threading
+
+import pytest
+
+import state_store
+from state_store import MemoryStateStore, SQLiteStateStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(state_store.time, "monotonic", lambda: now[0])
+    return now
+
+
+def sqlite_store(tmp_path, max_sessions=100):
+    return SQLiteStateStore(str(tmp_path / "state.db"), max_sessions, idle_ttl=3600, session_ttl=86400, flush_interval=3600)
+
+
+class FlakyConnection:
+    """Wraps the writer connection to fail or observe the batched write."""
+
+    def __init__(self, db, on_write):
+        self.db = db
+        self.on_write = on_write
+
+    def __enter__(self):
+        return self.db.__enter__()
+
+    def __exit__(self, *exc):
+        return self.db.__exit__(*exc)
+
+    def execute(self, *args):
+        return self.db.execute(*args)
+
+    def executemany(self, sql, rows):
+        self.on_write()
+        return self.db.executemany(sql, rows)
+
+
+def test_unknown_users_get_a_default_state_without_a_session():
+    store = MemoryStateStore(10, 3600)
+    assert store.get("u") == {"mode": "normal", "dream_history": []}
+    assert len(store) == 0
+
+
+def test_handlers_get_copies():
+    store = MemoryStateStore(10, 3600)
+    store.update("u", mode="math", chat_history=[1])
+    state = store.get("u")
+    state["chat_history"].append(2)
+    state["mode"] = "weather"
+    assert store.get("u")["chat_history"] == [1]
+    assert store.get("u")["mode"] == "math"
+
+
+def test_append_keeps_the_last_items():
+    store = MemoryStateStore(10, 3600)
+    store.append("u", "chat_history", 1, 2, 3, limit=2)
+    store.append("u", "chat_history", 4, limit=2)
+    assert store.get("u")["chat_history"] == [3, 4]
+
+
+def test_reset_replaces_the_state():
+    store = MemoryStateStore(10, 3600)
+    store.update("u", mode="math", chat_history=[1])
+    store.reset("u", mode="images")
+    assert store.get("u") == {"mode": "images", "dream_history": []}
+
+
+def test_least_recently_used_sessions_are_evicted():
+    store = MemoryStateStore(2, 3600)
+    store.update("a", mode="math")
+    store.update("b", mode="math")
+    store.get("a")
+    store.update("c", mode="math")
+    assert len(store) == 2
+    assert store.get("a")["mode"] == "math"
+    assert store.get("b")["mode"] == "normal"
+
+
+def test_sweep_drops_idle_sessions(clock):
+    store = MemoryStateStore(10, idle_ttl=60)
+    store.update("old", mode="math")
+    clock[0] += 50
+    store.update("new", mode="math")
+    clock[0] += 20
+    store.sweep()
+    assert store.get("old")["mode"] == "normal"
+    assert store.get("new")["mode"] == "math"
+
+
+def test_sqlite_sessions_survive_a_restart(tmp_path):
+    store = sqlite_store(tmp_path)
+    store.update("u", mode="dreamriddle", dream_history=["a door"])
+    store.flush()
+    assert sqlite_store(tmp_path).get("u") == {"mode": "dreamriddle", "dream_history": ["a door"]}
+
+
+def test_sqlite_evicted_sessions_are_kept_until_flushed(tmp_path):
+    store = sqlite_store(tmp_path, max_sessions=1)
+    store.update("a", mode="math")
+    store.update("b", mode="images")
+    assert store.get("a")["mode"] == "math"
+    store.flush()
+    assert sqlite_store(tmp_path).get("b")["mode"] == "images"
+
+
+def test_sqlite_flush_writes_outside_the_store_lock(tmp_path):
+    store = sqlite_store(tmp_path, max_sessions=1)
+    store.update("a", mode="math")
+    seen = []
+
+    def on_write():
+        # Evict "a" and read it back from another thread while its write is in progress
+        reader = threading.Thread(target=lambda: (store.update("b", mode="images"), seen.append(store.get("a")["mode"])))
+        reader.start()
+        reader.join(2)
+        assert not reader.is_alive(), "store lock held during the write"
+
+    store.db = FlakyConnection(store.db, on_write)
+    store.flush()
+    assert seen == ["math"]
+
+
+def test_sqlite_failed_flush_keeps_changes_dirty(tmp_path):
+    store = sqlite_store(tmp_path, max_sessions=1)
+    store.update("a", mode="math")
+    writer = store.db
+
+    def fail():
+        raise OSError("disk full")
+
+    store.db = FlakyConnection(writer, fail)
+    with pytest.raises(OSError):
+        store.flush()
+    store.update("b", mode="images")  # evicts "a" before it was ever written
+    store.db = writer
+    store.flush()
+    restarted = sqlite_store(tmp_path)
+    assert restarted.get("a")["mode"] == "math"
+    assert restarted.get("b")["mode"] == "images"
+
+
+def test_sqlite_expire_deletes_old_sessions(tmp_path, monkeypatch):
+    store = sqlite_store(tmp_path)
+    store.update("u", mode="math")
+    store.flush()
+    now = state_store.time.time()
+    monkeypatch.setattr(state_store.time, "time", lambda: now + 2 * 86400)
+    store.expire()
+    assert sqlite_store(tmp_path).get("u")["mode"] == "normal"
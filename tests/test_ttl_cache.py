@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import ttl_cache
+from ttl_cache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ttl_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_entries_expire(clock):
+    cache = TTLCache(10, ttl=60)
+    cache.set("a", 1)
+    clock[0] += 59
+    assert cache.get("a") == 1
+    clock[0] += 2
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_concurrent_misses_share_one_load():
+    cache = TTLCache(10, ttl=60)
+    calls = []
+    release = threading.Event()
+
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return "value"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load("k", loader))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join()
+    assert calls == [1]
+    assert results == ["value"] * 8
+    assert cache.get("k") == "value"
+
+
+def test_none_results_are_not_cached():
+    cache = TTLCache(10, ttl=60)
+    calls = []
+    assert cache.get_or_load("k", lambda: calls.append(1)) is None
+    assert cache.get_or_load("k", lambda: calls.append(1)) is None
+    assert len(calls) == 2
+
+
+def test_load_errors_reach_every_waiter_and_are_not_cached():
+    cache = TTLCache(10, ttl=60)
+    release = threading.Event()
+
+    def loader():
+        release.wait(5)
+        raise ValueError("upstream down")
+
+    errors = []
+
+    def load():
+        try:
+            cache.get_or_load("k", loader)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=load) for _ in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join()
+    assert len(errors) == 4
+    assert cache.get_or_load("k", lambda: "ok") == "ok"
+
+
+def test_async_and_thread_misses_share_one_load():
+    cache = TTLCache(10, ttl=60)
+    calls = []
+    started = threading.Event()
+
+    async def loader():
+        calls.append(1)
+        started.set()
+        await asyncio.sleep(0.05)
+        return "value"
+
+    async def main():
+        task = asyncio.ensure_future(cache.get_or_load_async("k", loader))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        from_thread = asyncio.get_running_loop().run_in_executor(None, cache.get_or_load, "k", lambda: calls.append(2))
+        return await task, await from_thread
+
+    assert asyncio.run(main()) == ("value", "value")
+    assert calls == [1]
@@ -0,0 +1,112 @@
+"""Thread-safe LRU cache with expiry and single-flight loading, shared by the
+thread and asyncio engines.
+"""
+
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+_MISSING = object()
+
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry.
+
+    Concurrent misses for the same key are collapsed into a single loader call
+    (single-flight); the other callers wait for and share its result.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.inflight = {}  # key -> Future
+        self.lock = threading.Lock()
+
+    def _lookup(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return _MISSING
+        if item[0] < time.monotonic():
+            del self.data[key]
+            return _MISSING
+        self.data.move_to_end(key)
+        return item[1]
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def _join(self, key):
+        """Returns (cached value, None, False), or the key's in-flight Future and whether we lead it."""
+        with self.lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                return value, None, False
+            flight = self.inflight.get(key)
+            if flight is not None:
+                return None, flight, False
+            flight = self.inflight[key] = Future()
+            return None, flight, True
+
+    def _land(self, key, flight, value=None, error=None):
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            if value is not None:
+                self.set(key, value)
+            flight.set_result(value)
+        with self.lock:
+            self.inflight.pop(key, None)
+
+    def get_or_load(self, key, loader):
+        """Return the cached value, or call loader() once for all concurrent misses.
+
+        None results are not cached.
+        """
+        value, flight, leader = self._join(key)
+        if flight is None:
+            return value
+        if not leader:
+            return flight.result()
+        try:
+            value = loader()
+        except Exception as e:
+            self._land(key, flight, error=e)
+            raise
+        self._land(key, flight, value)
+        return value
+
+    async def get_or_load_async(self, key, loader):
+        """get_or_load for coroutines: loader is an async function, and waiting doesn't block the loop.
+
+        Threads and coroutines missing on the same key share one load.
+        """
+        value, flight, leader = self._join(key)
+        if flight is None:
+            return value
+        if not leader:
+            return await asyncio.wrap_future(flight)
+        try:
+            value = await loader()
+        except BaseException as e:  # includes cancellation, so waiters aren't left hanging
+            self._land(key, flight, error=e)
+            raise
+        self._land(key, flight, value)
+        return value
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def __len__(self):
+        return len(self.data)